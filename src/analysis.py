@@ -9,6 +9,20 @@ import seaborn as sns
 
 from looper.models import Project
 
+from clustering import clustermap
+from decomposition import fit_pca
+from distances import group_distances
+from embedding import embed
+from enrichment import enrich, gene_set_index, gmt_file
+from expression_store import expression_store_file, read_expression_store
+from grouping import GroupIndex
+from normalization import normalize_frame
+from rank_tests import mann_whitney_u
+from rarefaction import rarefaction
+from signatures import (
+    signature_correlations, downsampled_signatures, save_downsampling, load_downsampling,
+    permutation_background, background_quantiles, save_background)
+
 
 # Set settings
 pd.set_option("date_dayfirst", True)
@@ -23,17 +37,14 @@ import sys
 sys.setrecursionlimit(10000)
 
 
-def normalize(df, experiment="", kind="total", results_dir="results"):
-    def normalize_by_total(df):
-        """
-        Normalize expression by total number of counts per cell.
-        """
-        return np.log2(1 + df.apply(lambda x: x / float(x.sum()), axis=0) * 1e4)
-
-    if kind == "total":
-        norm = normalize_by_total(df)
-        norm.to_hdf(os.path.join(results_dir, "digital_expression.500genes.{}.log2_tpm.hdf5.gz".format(experiment)), "log2_tpm", compression="gzip")
-        return norm
+def normalize(df, experiment="", kind="total", results_dir="results", dtype=np.float32, chunk_size=None):
+    """
+    Normalize expression per cell (by total number of counts per cell with `kind="total"`)
+    and log2 transform (see `normalization.normalize_matrix`).
+    """
+    norm = normalize_frame(df, kind=kind, dtype=dtype, chunk_size=chunk_size)
+    norm.to_hdf(os.path.join(results_dir, "digital_expression.500genes.{}.log2_tpm.hdf5.gz".format(experiment)), "log2_tpm", compression="gzip")
+    return norm
 
 
 def read_seurat_hdf5(hdf5_file):
@@ -55,9 +66,12 @@ def read_seurat_hdf5(hdf5_file):
     return seurat_matrix
 
 
-def unsupervised(df, experiment="CROP-seq_Jurkat_TCR", filter_low=False, results_dir="results"):
+def unsupervised(df, experiment="CROP-seq_Jurkat_TCR", filter_low=False, results_dir="results", scalable=False):
+    """
+    :param scalable: embed single cells on the principal components of highly variable genes,
+                     fitting methods concurrently (see `embedding.embed`), for large numbers of cells.
+    """
     # Inspect
-    from sklearn.decomposition import PCA
     from sklearn.manifold import TSNE, MDS, LocallyLinearEmbedding, SpectralEmbedding, Isomap
 
     methods = ["PCA", "TSNE", "LocallyLinearEmbedding", "SpectralEmbedding", "Isomap", "MDS"]
@@ -68,19 +82,23 @@ def unsupervised(df, experiment="CROP-seq_Jurkat_TCR", filter_low=False, results
 
     # Cells grouped by gene or grna
     for group in ["CTRL_cells", "all_cells"]:
-        df2 = df.copy()
+        df2 = df
         if group == 'CTRL_cells':
             df2 = df2[df2.columns[df2.columns.get_level_values("gene") == "CTRL"]]
 
+        df2_groups = GroupIndex(df2)
         for level in ["gene", "grna"]:
-            df_group = df2.T.groupby(level=[level_mapping['condition'], level_mapping[level]]).median().T
-            df_group.index = df2.index
+            df_group = df2_groups.median(["condition", level])
 
             fig, axis = plt.subplots(len(df_group.columns.levels), len(methods), figsize=(3 * len(methods), 3 * len(df_group.columns.levels)))
             for i, method in enumerate(methods):
-                model = eval(method)()
                 try:
-                    fitted = model.fit_transform(df_group.T)
+                    if method == "PCA":
+                        model = fit_pca(df_group.values.T, n_components=20)
+                        fitted = model.scores
+                    else:
+                        model = eval(method)()
+                        fitted = model.fit_transform(df_group.T)
                 except:
                     continue
 
@@ -101,7 +119,7 @@ def unsupervised(df, experiment="CROP-seq_Jurkat_TCR", filter_low=False, results
 
                     if method == "PCA":
                         fig2, axis2 = plt.subplots(1)
-                        axis2.plot(range(1, fitted.shape[0] + 1), (model.explained_variance_ / model.explained_variance_.sum()) * 100, "-o")
+                        axis2.plot(range(1, len(model.explained_variance_ratio_) + 1), model.explained_variance_ratio_ * 100, "-o")
                         axis2.set_xlabel("PC")
                         axis2.set_ylabel("% variance explained")
                         fig2.savefig(os.path.join(results_dir, "{}.clustering.{}.grouped_{}.PCA_variance.svg".format(experiment, group, level)), bbox_inches="tight")
@@ -116,10 +134,21 @@ def unsupervised(df, experiment="CROP-seq_Jurkat_TCR", filter_low=False, results
         else:
             df2 = df
 
+        if scalable:
+            embeddings, variance_ratio = embed(df2.values, methods=methods)
+            # only the methods `embed` fitted
+            methods = [m for m in methods if m in embeddings]
+
         fig, axis = plt.subplots(len(df2.columns.levels), len(methods) + 1, figsize=(3 * len(df2.columns.levels), 3 * len(methods)))
         for i, method in enumerate(methods):
-            model = eval(method)()
-            fitted = model.fit_transform(df2.T)
+            if scalable:
+                fitted = embeddings[method]
+            elif method == "PCA":
+                model = fit_pca(df2.values.T, n_components=20)
+                fitted, variance_ratio = model.scores, model.explained_variance_ratio_
+            else:
+                model = eval(method)()
+                fitted = model.fit_transform(df2.T)
 
             for j, level in enumerate(df2.columns.names):
                 if level == "cell":
@@ -134,7 +163,7 @@ def unsupervised(df, experiment="CROP-seq_Jurkat_TCR", filter_low=False, results
 
                 if method == "PCA":
                     fig2, axis2 = plt.subplots(1)
-                    axis2.plot(range(1, fitted.shape[0] + 1), (model.explained_variance_ / model.explained_variance_.sum()) * 100, "-o")
+                    axis2.plot(range(1, len(variance_ratio) + 1), variance_ratio * 100, "-o")
                     axis2.set_xlabel("PC")
                     axis2.set_ylabel("% variance explained")
                     fig2.savefig(os.path.join(results_dir, "{}.clustering.{}.PCA_variance.svg".format(experiment, group)), bbox_inches="tight")
@@ -150,8 +179,8 @@ def unsupervised(df, experiment="CROP-seq_Jurkat_TCR", filter_low=False, results
         fig.savefig(os.path.join(results_dir, "{}.clustering.{}.png".format(experiment, group)), bbox_inches="tight", dpi=300)
 
     # Expression of some markers in PCA
-    pca = PCA(n_components=2)
-    fitted = pca.fit(df2.T).transform(df2.T)
+    pca = fit_pca(df2.values.T, n_components=2)
+    fitted = pca.scores
     # eigenvalues = pca.explained_variance_ratio_
     # loadings = pca.components_
     # z_fitted = np.dot(fitted, loadings)
@@ -172,53 +201,55 @@ def significant_perturbation(df, df_bulk, de_genes, results_dir="results", exper
     """
     Assess whether a gRNA perturbation is significant.
     """
-    from scipy.stats import mannwhitneyu
     from statsmodels.sandbox.stats.multicomp import multipletests
     from statsmodels.nonparametric.smoothers_lowess import lowess
-    from scipy.stats import norm
+    from scipy.stats import norm, chi2
     from scipy.stats import combine_pvalues
 
     def z_score(x):
         return (x - x.mean()) / x.std()
 
     # Calculate perturbation p-values
-    results = pd.DataFrame()
+    results = list()
     for data_type, tmp_df in [("CROP", df), ("Bulk", df_bulk)]:
+        tmp_df_groups = GroupIndex(tmp_df)
+        # number of cells of each gRNA
+        codes, groups = tmp_df_groups.groups(["condition", "grna"])
+        n_cells = pd.Series(np.bincount(codes[codes >= 0], minlength=len(groups)), index=groups)
+
         for subset, index in [("all_genes", df.index), ("sig_genes", de_genes)]:
 
             # groupby gRNA, reduce to median
-            df_guide = tmp_df.ix[index].dropna().T.groupby(level=["condition", "gene", "grna"]).median().T
+            df_guide = tmp_df_groups.median(["condition", "gene", "grna"], genes=index)
 
             for condition in df_guide.columns.levels[0]:
-                ctrl = df_guide.loc[
-                    :, (df_guide.columns.get_level_values('grna').str.contains("CTRL")) & (df_guide.columns.get_level_values('condition') == condition)
-                ].median(axis=1)
-
-                # fit gaussian on control gRNA expression (null)
-                params = norm.fit(z_score(ctrl))
-
-                for grna in df_guide.columns.levels[2]:
-                    print(data_type, subset, condition, grna)
-                    g = df_guide.loc[
-                        :, (df_guide.columns.get_level_values('grna') == grna) & (df_guide.columns.get_level_values('condition') == condition)
-                    ].squeeze()
-                    n_cells = tmp_df.columns[
-                        (tmp_df.columns.get_level_values('grna') == grna) & (tmp_df.columns.get_level_values('condition') == condition)
-                    ].shape[0]
+                print(data_type, subset, condition)
+                guides = df_guide.loc[:, df_guide.columns.get_level_values('condition') == condition]
+                ctrl = guides.loc[:, guides.columns.get_level_values('grna').str.contains("CTRL")].median(axis=1)
 
-                    if g.empty or ctrl.empty:
-                        continue
-
-                    # get MannWhitney p-value
-                    s, p = mannwhitneyu(g.astype(np.float128), ctrl.astype(np.float128))
+                if guides.empty or ctrl.empty:
+                    continue
 
-                    # get p-value from fitted dist
-                    es, ep = combine_pvalues(norm.sf(abs(z_score(g)), *params) * 2)  # twosided p-value
+                # get MannWhitney p-values of all gRNAs
+                s, p = mann_whitney_u(guides.values, ctrl.values)
 
-                    results = results.append(pd.Series(
-                        [data_type, subset, condition, g.name[1], grna, s, p, n_cells, es, ep],
-                        index=["data_type", "subset", "condition", "gene", "grna", "stat", "p_value", "n_cells", "estat", "ep_value"]
-                    ), ignore_index=True)
+                # get p-values from gaussian fitted on control gRNA expression (null)
+                params = norm.fit(z_score(ctrl))
+                z = (guides - guides.mean()) / guides.std()
+                ps = norm.sf(abs(z.values), *params) * 2  # twosided p-value
+                # combine with Fisher's method, as `combine_pvalues`
+                with np.errstate(divide="ignore"):
+                    es = -2 * np.log(ps).sum(axis=0)
+                ep = chi2.sf(es, 2 * ps.shape[0])
+
+                results.append(pd.DataFrame({
+                    "data_type": data_type, "subset": subset, "condition": condition,
+                    "gene": guides.columns.get_level_values('gene'), "grna": guides.columns.get_level_values('grna'),
+                    "stat": s, "p_value": p,
+                    "n_cells": n_cells.reindex(list(zip(guides.columns.get_level_values('condition'), guides.columns.get_level_values('grna')))).values,
+                    "estat": es, "ep_value": ep}))
+    results = pd.concat(results, ignore_index=True)[
+        ["data_type", "subset", "condition", "gene", "grna", "stat", "p_value", "n_cells", "estat", "ep_value"]]
 
     results = results[~results["grna"].str.contains("CTRL")]
 
@@ -323,23 +354,19 @@ def differential_genes(df, experiment, method="pca", results_dir="results", n_ge
     """
     """
     def pca(df, level="gene", filter_low=True, percentile=99):
-        from sklearn.decomposition import PCA
-        level_mapping = dict(zip(df.columns.names, range(len(df.columns.names))))
-
         if filter_low:
             df2 = df[df.sum().sort_values().tail(int(df.shape[1] * 0.25)).index]  # get top 25% covered cells
         else:
             df2 = df
 
         # Cells grouped by gene
-        df_group = df2.T.groupby(level=[level_mapping["condition"], level_mapping[level]]).mean().T
-        df_group.index = df2.index
+        df_group = GroupIndex(df2).mean(["condition", level])
 
-        fitted = PCA().fit_transform(df_group)  # for genes
+        fitted = fit_pca(df_group.values, n_components=2).scores  # for genes
         r = pd.Series(fitted[:, 1], index=df2.index).sort_values()
         de_genes = r[abs(r) > np.percentile(abs(r), percentile)].index
 
-        g = sns.clustermap(
+        g = clustermap(
             df2.ix[de_genes],
             metric="correlation",
             z_score=0,
@@ -354,7 +381,7 @@ def differential_genes(df, experiment, method="pca", results_dir="results", n_ge
         g.fig.savefig(os.path.join(results_dir, "{}.{}genes.PCA.clustering.png".format(experiment, n_genes)), bbox_inches="tight", dpi=300)
         g.fig.savefig(os.path.join(results_dir, "{}.{}genes.PCA.clustering.svg".format(experiment, n_genes)), bbox_inches="tight")
 
-        g = sns.clustermap(
+        g = clustermap(
             df_group.ix[de_genes],
             metric="correlation",
             z_score=0,
@@ -432,46 +459,23 @@ def enrich_signature(method="pca", percentile=99, results_dir="results", experim
 def stimulation_signature(
         df, df_bulk, de_genes,
         experiment="CROP-seq_Jurkat_TCR", n_genes=500, method="pca", cond1="stimulated", cond2="unstimulated",
-        percentile=99, results_dir="results"):
+        percentile=99, results_dir="results", counts=None):
+    """
+    :param counts: genes x cells matrix of UMI counts of the cells in `df`, to assess the signature with fewer UMIs per cell.
+    """
     from scipy.stats import pearsonr, spearmanr
 
-    def generate_signature_matrix(array, n=101, bounds=(0, 0)):
-        """
-        :param np.array: 2D np.array
-        """
-        def get_score(i, j, p, n):
-            """Get signature score between p% of the values of the two groups."""
-            return ((float(i) * p) + (float(j) * (n - p))) / n
-
-        matrix = np.zeros([array.shape[0], n])
-        for x in range(array.shape[0]):
-            for y, p in enumerate(np.linspace(0 + bounds[0], n + bounds[1], n)):
-                matrix[x, y] = get_score(array[x, 0], array[x, 1], p, n)
+    # groups of cells of each matrix, shared by all steps
+    df_groups, df_bulk_groups = GroupIndex(df), GroupIndex(df_bulk)
 
-        return matrix
-
-    def best_signature_matrix(array, matrix):
-        """
-        :param np.array: 2D np.array
-        """
-        from scipy.stats import pearsonr
-
-        res = dict()
-        for i in range(matrix.shape[1]):
-            res[i] = pearsonr(array, matrix[:, i])
-
-        cors = {i: x[0] for i, x in res.items()}
-        p_values = {i: x[1] for i, x in res.items()}
-        return cors, p_values
-
-    for data_type, matrix in [("CROP", df), ("Bulk", df_bulk)]:
+    for data_type, matrix, matrix_groups in [("CROP", df, df_groups), ("Bulk", df_bulk, df_bulk_groups)]:
         if data_type == "CROP":
             prefix = "{}.{}genes.{}".format(experiment, n_genes, method)
         else:
             prefix = "{}.{}.{}".format(experiment, data_type, method)
 
         # Cluster all cells on DE genes
-        g = sns.clustermap(
+        g = clustermap(
             matrix.ix[de_genes],
             metric="correlation",
             z_score=0,
@@ -486,7 +490,7 @@ def stimulation_signature(
         g.fig.savefig(os.path.join(results_dir, "{}.all_cells.clustering.png".format(prefix)), bbox_inches="tight", dpi=300)
 
         # Correlate all cells on DE genes
-        g = sns.clustermap(
+        g = clustermap(
             matrix.ix[de_genes].corr(),
             cmap="BrBG",
             metric="correlation",
@@ -501,7 +505,7 @@ def stimulation_signature(
         g.fig.savefig(os.path.join(results_dir, "{}.all_cells.clustering.correlation.png".format(prefix)), bbox_inches="tight", dpi=300)
 
         # Cluster CTRL cells on DE genes
-        g = sns.clustermap(
+        g = clustermap(
             matrix[matrix.columns[matrix.columns.get_level_values('gene') == "CTRL"]].ix[de_genes],
             metric="correlation",
             z_score=0,
@@ -516,7 +520,7 @@ def stimulation_signature(
         g.fig.savefig(os.path.join(results_dir, "{}.control_cells.clustering.svg".format(prefix)), bbox_inches="tight")
 
         # Correlate CTRL cells on DE genes
-        g = sns.clustermap(
+        g = clustermap(
             matrix[matrix.columns[matrix.columns.get_level_values('gene') == "CTRL"]].ix[de_genes].corr(),
             cmap="BrBG",
             metric="correlation",
@@ -533,10 +537,10 @@ def stimulation_signature(
         # Cluster groups of targeted gRNAs/genes
         # get condition/gene mean expression for every gene
         for level in ["gene", "grna"]:
-            matrix_level_means = matrix.T.groupby(level=["condition", level]).mean().T
+            matrix_level_means = matrix_groups.mean(["condition", level])
             # grna level
             # cluster mean gene expression
-            g = sns.clustermap(
+            g = clustermap(
                 matrix_level_means.ix[de_genes],
                 z_score=0,
                 vmin=-3, vmax=3,
@@ -550,7 +554,7 @@ def stimulation_signature(
             g.fig.savefig(os.path.join(results_dir, "{}.{}_level.clustering.svg".format(prefix, level)), bbox_inches="tight")
 
             # order
-            g = sns.clustermap(
+            g = clustermap(
                 matrix_level_means.ix[de_genes],
                 z_score=0,
                 vmin=-3, vmax=3,
@@ -564,7 +568,7 @@ def stimulation_signature(
             g.fig.savefig(os.path.join(results_dir, "{}.{}_level.ordered_heatmap.svg".format(prefix, level)), bbox_inches="tight")
 
             # correlation
-            g = sns.clustermap(
+            g = clustermap(
                 matrix_level_means.ix[de_genes].corr(),
                 cmap="BrBG",
                 row_cluster=True, col_cluster=True,
@@ -583,42 +587,42 @@ def stimulation_signature(
 
     # Get stimulation signature
     # 1. get mean expression of each group in signature gens
-    df_gene_means = df.T.groupby(level=["condition", "gene"]).median().T
+    df_gene_means = df_groups.median(["condition", "gene"])
     x1 = df_gene_means[df_gene_means.columns[df_gene_means.columns.get_level_values("condition") == cond1]].median(axis=1).ix[de_genes]
     x1.name = cond1
     x2 = df_gene_means[df_gene_means.columns[df_gene_means.columns.get_level_values("condition") == cond2]].median(axis=1).ix[de_genes]
     x2.name = cond2
 
-    # 2. get signature matrix
+    # 2. signature positions (see `generate_signature_matrix`)
     # here, bounds are set to (-20, 20) so that the extremes of the signature represent -20% or 120% of the signature
     # this is done because the extreme values (0 and 100%) values correspond to the mean value within each group,
     # meaning that some cells are expected to surpass those values.
-    sign_mat = generate_signature_matrix(np.vstack([x1, x2]).T, n=101, bounds=(-20, 20))
 
     # 3. get signature value of each cell
-    for fraction in np.linspace(0, 1, 100)[1:]:
-        df_sub = df * fraction
-        df_sub[df_sub < 1] = 0
-        cors = list()
-        p_values = list()
-        for i, cell in enumerate(df.columns):
-            if i % 100 == 0:
-                print(i)
-            cor, p_value = best_signature_matrix(array=df.ix[de_genes][cell], matrix=sign_mat)
-            cors.append(cor)
-            p_values.append(p_value)
-
-        cors = pd.DataFrame(cors, index=df.columns)
-        p_values = pd.DataFrame(p_values, index=df.columns)
-
-        cors.to_csv(os.path.join(results_dir, "{}.{}genes.signature.all_cells.matrix_correlation.{}.csv".format(experiment, n_genes, fraction)))
-        p_values.to_csv(os.path.join(results_dir, "{}.{}genes.signature.all_cells.matrix_p_values.{}.csv".format(experiment, n_genes, fraction)))
+    cors, p_values = signature_correlations(df.ix[de_genes].values, x1, x2, n=101, bounds=(-20, 20))
+    cors = pd.DataFrame(cors, index=df.columns)
+    p_values = pd.DataFrame(p_values, index=df.columns)
+
+    cors.to_csv(os.path.join(results_dir, "{}.{}genes.signature.all_cells.matrix_correlation.csv".format(experiment, n_genes)))
+    p_values.to_csv(os.path.join(results_dir, "{}.{}genes.signature.all_cells.matrix_p_values.csv".format(experiment, n_genes)))
+
+    # 3a. get signature value of each cell with its UMIs downsampled to fractions of the total
+    if counts is not None:
+        counts = counts[df.columns]
+        signature_counts = counts.ix[de_genes].fillna(0).values
+        fractions = np.linspace(0, 1, 100)[1:]
+        downsampled_cors, downsampled_p_values = downsampled_signatures(
+            signature_counts, counts.sum(axis=0).values - signature_counts.sum(axis=0), x1, x2,
+            fractions=fractions, n=101, bounds=(-20, 20))
+        save_downsampling(
+            os.path.join(results_dir, "{}.{}genes.signature.all_cells.downsampling.npz".format(experiment, n_genes)),
+            fractions, downsampled_cors, downsampled_p_values)
 
     # visualize
     # sorted by max
     sigs = cors.apply(lambda x: np.argmax(x), axis=1).astype(float).sort_values()
 
-    g = sns.clustermap(
+    g = clustermap(
         cors.ix[sigs.index],
         z_score=0,
         row_cluster=False, col_cluster=False,
@@ -626,7 +630,7 @@ def stimulation_signature(
         row_colors=get_level_colors(cors.ix[sigs.index].index))
     g.savefig(os.path.join(results_dir, "{}.{}genes.signature.all_cells.correlation_matrix.sorted.png".format(experiment, n_genes)), bbox_inches="tight", dpi=300)
 
-    g = sns.clustermap(
+    g = clustermap(
         -np.log10(p_values).ix[sigs.index],
         z_score=0,
         row_cluster=False, col_cluster=False,
@@ -640,7 +644,7 @@ def stimulation_signature(
 
         p = p_values.groupby(level=['condition', level])
 
-        g = sns.clustermap(
+        g = clustermap(
             c.ix[cs.index],
             z_score=0,
             row_cluster=False, col_cluster=False,
@@ -653,89 +657,44 @@ def stimulation_signature(
         g.savefig(os.path.join(results_dir, "{}.{}genes.signature.all_cells.correlation_matrix.sorted.{}.png".format(experiment, n_genes, level)), bbox_inches="tight", dpi=300)
 
     # 3b. get background of signature correlations/positions
-    if data_type == "CROP":
-        n_permutations = 100
-        for i in range(n_permutations):
-            background_matrix = df.ix[de_genes].copy().values.flatten()
-            np.random.shuffle(background_matrix)  # shuffle only shuffles in one dimention!
-            background_matrix = background_matrix.reshape(df.ix[de_genes].shape)
-            c = list()
-            p = list()
-            for j in range(background_matrix.shape[1]):
-                if j % 100 == 0:
-                    print(i, j)
-                cor, p_value = best_signature_matrix(array=background_matrix[:, j], matrix=sign_mat)
-                c.append(cor)
-                p.append(p_value)
-
-            if i == 0:
-                random_cors = pd.DataFrame(c, index=df.columns)
-                random_p_values = pd.DataFrame(p, index=df.columns)
-            else:
-                random_cors = random_cors.append(pd.DataFrame(c, index=df.columns))
-                random_p_values = random_p_values.append(pd.DataFrame(p, index=df.columns))
-
-        random_cors.to_csv(os.path.join(results_dir, "{}.{}genes.signature.random_cells.matrix_correlation.csv".format(experiment, n_genes)))
-        random_p_values.to_csv(os.path.join(results_dir, "{}.{}genes.signature.random_cells.matrix_p_values.csv".format(experiment, n_genes)))
+    background = permutation_background(df.ix[de_genes].values, x1, x2, n_permutations=1000, n=101, bounds=(-20, 20))
+    save_background(os.path.join(results_dir, "{}.{}genes.signature.random_cells.background.npz".format(experiment, n_genes)), background)
+    q = [0.01, 0.05, 0.5, 0.95, 0.99]
+    random_quantiles = pd.DataFrame(background_quantiles(background, q), index=cors.columns, columns=q)
+    random_quantiles.to_csv(os.path.join(results_dir, "{}.{}genes.signature.random_cells.quantiles.csv".format(experiment, n_genes)))
 
     # visualize
-    i = np.random.choice(range(len(random_cors.index)), 5000)
-
-    # sorted by max
-    random_sigs = random_cors.iloc[i].apply(lambda x: np.argmax(x), axis=1).sort_values()
-
-    g = sns.clustermap(
-        random_cors.iloc[i].ix[random_sigs.index],
-        z_score=0,
-        row_cluster=False, col_cluster=False,
-        yticklabels=False, xticklabels=False,
-        row_colors=get_level_colors(random_cors.iloc[i].ix[random_sigs.index].index))
-    g.savefig(os.path.join(results_dir, "{}.{}genes.signature.random_cells.correlation_matrix.sorted.png".format(experiment, n_genes)), dpi=300, bbox_inches="tight")
-
-    g = sns.clustermap(
-        -np.log10(random_p_values.iloc[i]).ix[random_sigs.index],
-        z_score=0,
-        row_cluster=False, col_cluster=False,
-        yticklabels=False, xticklabels=False,
-        row_colors=get_level_colors(random_p_values.iloc[i].ix[random_sigs.index].index))
-    g.savefig(os.path.join(results_dir, "{}.{}genes.signature.random_cells.pvalue_matrix.sorted.png".format(experiment, n_genes)), dpi=300, bbox_inches="tight")
-
-    for level in ['grna', 'gene']:
-        c = random_cors.groupby(level=['condition', level]).mean()
-        cs = c.apply(lambda x: np.argmax(x), axis=1).sort_values()
-
-        p = random_p_values.groupby(level=['condition', level])
-
-        g = sns.clustermap(
-            c.ix[cs.index],
-            z_score=0,
-            row_cluster=False, col_cluster=False,
-            yticklabels=True, xticklabels=False,
-            row_colors=get_level_colors(c.ix[cs.index].index))
-        for item in g.ax_heatmap.get_yticklabels():
-            item.set_rotation(0)
-            item.set_fontsize(8)
-        g.savefig(os.path.join(results_dir, "{}.{}genes.signature.random_cells.matrix_pvalue_matrix.sorted.{}.png".format(experiment, n_genes, level)), dpi=300, bbox_inches="tight")
+    # distribution of correlations along the signature: observed vs permuted
+    fig, axis = plt.subplots(1, 2, figsize=(4 * 2, 4))
+    positions = np.arange(random_quantiles.shape[0])
+    axis[0].fill_between(positions, random_quantiles[0.01], random_quantiles[0.99], color="grey", alpha=0.25)
+    axis[0].fill_between(positions, random_quantiles[0.05], random_quantiles[0.95], color="grey", alpha=0.5)
+    axis[0].plot(positions, random_quantiles[0.5], color="grey")
+    axis[0].plot(positions, cors.median(axis=0).values, color="red")
+    axis[0].set_xlabel("Signature position")
+    axis[0].set_ylabel("Correlation")
+    # position of highest correlation
+    axis[1].plot(positions, background["best"] / float(background["best"].sum()), color="grey", label="permuted")
+    axis[1].plot(positions, np.bincount(cors.values.argmax(axis=1), minlength=len(positions)) / float(cors.shape[0]), color="red", label="observed")
+    axis[1].set_xlabel("Signature position")
+    axis[1].set_ylabel("Fraction of cells")
+    axis[1].legend()
+    sns.despine(fig)
+    fig.savefig(os.path.join(results_dir, "{}.{}genes.signature.random_cells.background.svg".format(experiment, n_genes)), bbox_inches="tight")
 
     #
 
     # 3c. get signature value of each bulk sample
 
     # get signature matrix from bulk samples on the same genes
-    df_bulk_gene_means = df_bulk.T.groupby(level=["condition", "gene"]).median().T.ix[de_genes].dropna()
+    df_bulk_gene_means = df_bulk_groups.median(["condition", "gene"], genes=de_genes)
     bx1 = df_bulk_gene_means[df_bulk_gene_means.columns[df_bulk_gene_means.columns.get_level_values("condition") == cond1]].median(axis=1)
     bx1.name = cond1
     bx2 = df_bulk_gene_means[df_bulk_gene_means.columns[df_bulk_gene_means.columns.get_level_values("condition") == cond2]].median(axis=1)
     bx2.name = cond2
-    bulk_sign_mat = generate_signature_matrix(np.vstack([bx1, bx2]).T, n=101, bounds=(-20, 20))
-
-    bulk_cors = list()
-    bulk_p_values = list()
-    for i, sample in enumerate(df_bulk.columns):
-        cor, p_value = best_signature_matrix(array=df_bulk[sample].ix[df_bulk_gene_means.index], matrix=bulk_sign_mat)
-        bulk_cors.append(cor)
-        bulk_p_values.append(p_value)
 
+    bulk_cors, bulk_p_values = signature_correlations(
+        df_bulk.ix[df_bulk_gene_means.index].values, bx1, bx2, n=101, bounds=(-20, 20))
     bulk_cors = pd.DataFrame(bulk_cors, index=df_bulk.columns)
     bulk_p_values = pd.DataFrame(bulk_p_values, index=df_bulk.columns)
 
@@ -748,7 +707,7 @@ def stimulation_signature(
     # sorted by max
     sigs = bulk_cors.apply(lambda x: np.argmax(x), axis=1).astype(float).sort_values()
 
-    g = sns.clustermap(
+    g = clustermap(
         bulk_cors.ix[sigs.index],
         z_score=0,
         row_cluster=False, col_cluster=False,
@@ -759,7 +718,7 @@ def stimulation_signature(
         item.set_fontsize(8)
     g.savefig(os.path.join(results_dir, "{}.{}genes.signature.Bulk.correlation_matrix.sorted.svg".format(experiment, n_genes)), bbox_inches="tight")
 
-    g = sns.clustermap(
+    g = clustermap(
         -np.log10(bulk_p_values).ix[sigs.index],
         z_score=0,
         row_cluster=False, col_cluster=False,
@@ -776,7 +735,7 @@ def stimulation_signature(
 
         p = bulk_p_values.groupby(level=['condition', level])
 
-        g = sns.clustermap(
+        g = clustermap(
             c.ix[cs.index],
             z_score=0,
             row_cluster=False, col_cluster=False,
@@ -799,7 +758,7 @@ def stimulation_signature(
     # fits = fits.join(fits['x'].apply(pd.Series)).drop('x', axis=1).rename(columns={0: cond1, 1: cond2})
 
     # 5. investigate signatures
-    for data_type, matrix in [("CROP", df), ("Bulk", df_bulk)]:
+    for data_type, matrix, matrix_groups in [("CROP", df, df_groups), ("Bulk", df_bulk, df_bulk_groups)]:
         if data_type == "CROP":
             index = ['condition', 'replicate', 'cell', 'grna', 'gene']
             cors = pd.read_csv(os.path.join(results_dir, "{}.{}genes.signature.{}.matrix_correlation.csv".format(experiment, n_genes, "all_cells")))
@@ -939,10 +898,10 @@ def stimulation_signature(
             # Make heatmap sorted by median signature position per knockout
 
             # Group by stimulation / gRNA, get mean expression
-            level_matrix = matrix.ix[de_genes].dropna().T.groupby(level=['condition', level]).mean()
+            level_matrix = matrix_groups.mean(['condition', level], genes=de_genes).T
 
             # cluster
-            g = sns.clustermap(
+            g = clustermap(
                 level_matrix.T, z_score=0,
                 col_colors=get_level_colors(level_matrix.index),
                 metric='correlation',
@@ -956,7 +915,7 @@ def stimulation_signature(
             g.fig.savefig(os.path.join(results_dir, "{}.{}genes.differential_expression.{}.{}_group_means.clustered.svg".format(experiment, n_genes, data_type, level)), bbox_inches="tight")
 
             # cluster groups, sort genes
-            g = sns.clustermap(
+            g = clustermap(
                 level_matrix.ix[sigs_mean.sort_values("signature").index].T, z_score=0,
                 col_colors=get_level_colors(level_matrix.ix[sigs_mean.sort_values("signature").index].index),
                 metric='correlation',
@@ -970,7 +929,7 @@ def stimulation_signature(
             g.fig.savefig(os.path.join(results_dir, "{}.{}genes.differential_expression.{}.{}_group_means.sorted_genes_clustered_groups.svg".format(experiment, n_genes, data_type, level)), bbox_inches="tight")
 
             # sort by signature
-            clust = sns.clustermap(
+            clust = clustermap(
                 level_matrix.ix[sigs_mean.sort_values("signature").index], z_score=1,
                 row_colors=get_level_colors(sigs_mean.sort_values("signature").index),
                 metric='correlation',
@@ -1017,7 +976,7 @@ def stimulation_signature(
                 df2 = df2.reset_index().sort_values(["sortby", "condition", level]).drop(['sortby'], axis=1).set_index(['condition', level]).T
 
                 # sort by signature
-                g = sns.clustermap(
+                g = clustermap(
                     df2.ix[de_genes].T,
                     z_score=1, vmin=-1.5, vmax=1.5,
                     row_colors=get_level_colors(df2.columns),
@@ -1098,51 +1057,42 @@ def stimulation_signature(
     index = ['condition', 'sample_name', 'grna', 'gene']
     bulk_sigs = pd.read_csv(os.path.join(results_dir, "{}.{}genes.signature.{}.all_cells.correlation.csv".format(experiment, n_genes, "Bulk"))).set_index(index)
 
+    # Signatures of cells downsampled to fractions of their UMIs
+    index = ['condition', 'replicate', 'cell', 'grna', 'gene']
+    cells = pd.read_csv(os.path.join(results_dir, "{}.{}genes.signature.all_cells.matrix_correlation.csv".format(experiment, n_genes))).set_index(index).index
+    umi_fractions, downsampled_cors, _ = load_downsampling(
+        os.path.join(results_dir, "{}.{}genes.signature.all_cells.downsampling.npz".format(experiment, n_genes)))
+
     # Start subsampling in 100 fractions of the data
     n_iter = 100
+    cell_fractions = np.linspace(0.0, 1.0, 100)[1:]
+    signatures = downsampled_cors.argmax(axis=2)
     rare_metrics = pd.DataFrame()
-    for i in range(n_iter):
-        for umi_fraction in np.linspace(0.0, 1.0, 100)[1:]:
-            data_type = "CROP"
-            index = ['condition', 'replicate', 'cell', 'grna', 'gene']
-            cors = pd.read_csv(os.path.join(results_dir, "{}.{}genes.signature.all_cells.matrix_correlation.{}.csv".format(experiment, n_genes, umi_fraction))).set_index(index)
-            sigs = cors.apply(lambda x: np.argmax(x), axis=1)
-            sigs.name = "signature"
-            sigs = pd.DataFrame(sigs)
-            for condition in [cond1]:
-                # Compare aggregate signatures at both levels:
-                for level in ["gene", "grna"]:
-
-                    bulk_sigs_mean = bulk_sigs.astype(float).groupby(level=['condition', level]).mean()
-                    bulk_sigs_mean['signature'] = bulk_sigs_mean['signature'].replace(0, 1)  # to avoid -inf fold changes, could be done differently too
-                    bulk_sigs_mean['data_type'] = "Bulk"
-
-                    for cell_fraction in np.linspace(0.0, 1.0, 100)[1:]:
-                        print(i, umi_fraction, cell_fraction, condition, level)
-                        total = sigs.shape[0]
-                        # Subsample a fraction of all cells (maintains the distribution of recovered cells)
-                        chosen_indexes = np.random.choice(sigs.index, int(np.round(cell_fraction * total)))
-
-                        sigs_mean = sigs.ix[chosen_indexes].astype(float).groupby(level=['condition', level]).mean()
-                        sigs_mean['signature'] = sigs_mean['signature'].replace(0, 1)  # to avoid -inf fold changes, could be done differently too
-                        sigs_mean['data_type'] = "CROP"
-
-                        # Match CROP and Bulk
-                        t = sigs_mean.append(bulk_sigs_mean).reset_index()
-                        if level == 'grna':
-                            t['grna'] = t['grna'].str.replace("Tcrlibrary_", "")
+    # Compare aggregate signatures at both levels:
+    for level in ["gene", "grna"]:
+        bulk_sigs_mean = bulk_sigs['signature'].astype(float).groupby(level=['condition', level]).mean()
+        bulk_sigs_mean = bulk_sigs_mean.replace(0, 1)  # to avoid -inf fold changes, could be done differently too
 
-                        # Measure correlations
-                        t_pivot = pd.pivot_table(t, index=['condition', level], columns="data_type", values="signature").dropna()
-                        p = pearsonr(t_pivot["CROP"], t_pivot["Bulk"])[0]
+        # Match CROP and Bulk groups
+        bulk_groups = bulk_sigs_mean.index
+        cell_groups = pd.MultiIndex.from_arrays([cells.get_level_values('condition'), cells.get_level_values(level)])
+        if level == 'grna':
+            bulk_groups = bulk_groups.set_levels(bulk_groups.levels[1].str.replace("Tcrlibrary_", ""), level=1)
+            cell_groups = cell_groups.set_levels(cell_groups.levels[1].str.replace("Tcrlibrary_", ""), level=1)
 
-                        rare_metrics = rare_metrics.append(pd.Series(
-                            [i, condition, level, umi_fraction, cell_fraction, p],
-                            index=["iteration", "condition", "level", "umi_fraction", "cell_fraction", "pearson"]), ignore_index=True)
+        print("Rarefaction at {} level".format(level))
+        pearson = rarefaction(
+            signatures, bulk_groups.get_indexer(cell_groups), bulk_sigs_mean.values,
+            cell_fractions=cell_fractions, n_replicates=n_iter,
+            checkpoint_dir=os.path.join(results_dir, "rarefaction_analysis", "{}.{}".format(experiment, level)))
 
-        rare_metrics.to_csv(os.path.join(results_dir, "{}.signature.rarefaction_analysis.{}_iterations.csv".format(experiment, i)), index=False)
+        umi, cell, iteration = np.meshgrid(umi_fractions, cell_fractions, np.arange(n_iter), indexing="ij")
+        rare_metrics = rare_metrics.append(pd.DataFrame({
+            "iteration": iteration.ravel(), "condition": cond1, "level": level,
+            "umi_fraction": umi.ravel(), "cell_fraction": cell.ravel(), "pearson": pearson.ravel()}), ignore_index=True)
 
-    rare_metrics = pd.read_csv(os.path.join(results_dir, "{}.signature.rarefaction_analysis.{}_iterations.csv".format(experiment, n_iter)))
+    rare_metrics = rare_metrics[["iteration", "condition", "level", "umi_fraction", "cell_fraction", "pearson"]]
+    rare_metrics.to_csv(os.path.join(results_dir, "{}.signature.rarefaction_analysis.{}_iterations.csv".format(experiment, n_iter)), index=False)
 
     # Plot metrics
 
@@ -1183,7 +1133,7 @@ def stimulation_signature(
             print(cmap, i)
             # make pivot
             rare_pivot = pd.pivot_table(
-                rare_metrics[(rare_metrics['level'] == level) & (rare_metrics['condition'] == condition)],
+                rare_metrics[(rare_metrics['level'] == level) & (rare_metrics['condition'] == cond1)],
                 index="cell_fraction", columns="umi_fraction", values="pearson").sort_index(ascending=False)
 
             from scipy import ndimage
@@ -1210,18 +1160,17 @@ def stimulation_signature(
         fig.savefig(os.path.join(
             results_dir, "..",
             "{}.signature.rarefaction_analysis.{}_iterations.{}.joint_sampling.heatmap.{}.png".format(
-                experiment, n_iter, condition, cmap)), bbox_inches="tight", dpi=300)
+                experiment, n_iter, cond1, cmap)), bbox_inches="tight", dpi=300)
         fig.savefig(os.path.join(
             results_dir, "..",
             "{}.signature.rarefaction_analysis.{}_iterations.{}.joint_sampling.heatmap.{}.svg".format(
-                experiment, n_iter, condition, cmap)), bbox_inches="tight")
+                experiment, n_iter, cond1, cmap)), bbox_inches="tight")
 
 
 def intra_variability(df, df_bulk, de_genes, experiment="CROP-seq_Jurkat_TCR", results_dir="results"):
     """
     Measure between-gRNA, intra-gene variability
     """
-    from sklearn.metrics.pairwise import pairwise_distances
     from scipy.stats import mannwhitneyu
     from scipy.stats import norm
     from scipy.stats import combine_pvalues
@@ -1233,43 +1182,39 @@ def intra_variability(df, df_bulk, de_genes, experiment="CROP-seq_Jurkat_TCR", r
     def z_score(x):
         return (x - x.mean()) / x.std()
 
+    df_groups, df_bulk_groups = GroupIndex(df), GroupIndex(df_bulk)
+
     # Pairwise distances between gRNAs
-    results = pd.DataFrame()
-    for data_type, tmp_df in [("CROP", df), ("Bulk", df_bulk)]:
+    results = list()
+    for data_type, tmp_df, tmp_df_groups in [("CROP", df, df_groups), ("Bulk", df_bulk, df_bulk_groups)]:
         for subset, index in [("all_genes", df.index), ("sig_genes", de_genes)]:
 
             # groupby gRNA, reduce to median
-            df_guide = tmp_df.ix[index].dropna().T.groupby(level=["condition", "gene", "grna"]).mean().T
-
-            # compute all pairwise distances
-            # euc = pd.DataFrame(np.triu(squareform(pdist(df_guide.T, metric='euclidean'))), index=df_guide.columns, columns=df_guide.columns).replace(0, np.nan)
-            euc = pd.DataFrame(np.triu(pairwise_distances(df_guide.T, metric='l2')), index=df_guide.columns, columns=df_guide.columns).replace(0, np.nan)
-
-            # ignore self-distances
-            np.fill_diagonal(euc.values, pd.np.nan)
+            df_guide = tmp_df_groups.mean(["condition", "gene", "grna"], genes=index)
 
             # get intra-gene and between-genes gRNA distances
-            for condition in euc.columns.levels[0]:
-                for gene in euc.columns.levels[1]:
-                    for mask_name, mask_y in [  # either intra-gene or inter-gene distances
-                            ("intra", (euc.index.get_level_values('gene') == gene) & (euc.index.get_level_values('condition') == condition)),
-                            ("inter", (euc.index.get_level_values('gene') != gene) & (euc.index.get_level_values('condition') == condition))]:
-                        # get values
-                        series = pd.DataFrame(euc.loc[
-                            (euc.index.get_level_values('gene') == gene) & (euc.index.get_level_values('condition') == condition),
-                            mask_y
-                        ].values.flatten(), columns=["distances"]).dropna()
-                        # label data
-                        series["data_type"] = data_type
-                        series["subset"] = subset
-                        series["condition"] = condition
-                        series["gene"] = gene
-                        series["relation"] = mask_name
-                        results = results.append(series)
+            series = group_distances(
+                df_guide.values.T,
+                df_guide.columns.get_level_values('condition'), df_guide.columns.get_level_values('gene'),
+                metric="euclidean").rename(columns={"group": "gene"})
+            # label data
+            series["data_type"] = data_type
+            series["subset"] = subset
+            results.append(series)
+    results = pd.concat(results, ignore_index=True)[["distances", "data_type", "subset", "condition", "gene", "relation"]]
 
     results.to_csv(os.path.join(results_dir, "{}.intra_gene_variation_grna_level.euc.csv".format(experiment)), index=False)
     results = pd.read_csv(os.path.join(results_dir, "{}.intra_gene_variation_grna_level.euc.csv".format(experiment)))
 
+    # get gRNA efficiency and cell number
+    annot = pd.read_csv(os.path.join("metadata", "guide_annotation.csv"))
+    grna_var = annot.groupby(["gene"])["specificity_score", "efficiency_score"].std().reset_index()
+
+    # variation of the cell number of gRNAs of each gene
+    codes, groups = df_groups.groups(["condition", "gene", "grna"])
+    n_cells = pd.Series(np.bincount(codes[codes >= 0], minlength=len(groups)), index=groups).groupby(level=['condition', 'gene']).std()
+    n_cells.name = "n_cells"
+
     # Test differences between type of gRNA pairs
     fig, axis = plt.subplots(1)
     results.groupby(["data_type", "subset", "condition"]).apply(
@@ -1351,14 +1296,6 @@ def intra_variability(df, df_bulk, de_genes, experiment="CROP-seq_Jurkat_TCR", r
             dist_std.name = "distance_std"
             dist = pd.DataFrame([dist_mean, dist_std]).T
 
-            # get gRNA efficiency and cell number
-            annot = pd.read_csv(os.path.join("metadata", "guide_annotation.csv"))
-            grna_var = annot.groupby(["gene"])["specificity_score", "efficiency_score"].std().reset_index()
-
-            # add cell number
-            n_cells = df.T.groupby(level=["condition", "gene", "grna"]).apply(len).groupby(level=['condition', 'gene']).std()
-            n_cells.name = "n_cells"
-
             # put all together
             diff = pd.merge(
                 pd.merge(
@@ -1397,16 +1334,15 @@ def intra_variability(df, df_bulk, de_genes, experiment="CROP-seq_Jurkat_TCR", r
             g.fig.savefig(os.path.join(results_dir, "{}.intra_gene_variation_grna_level.{}.{}.euc.metrics.pairplot.svg".format(experiment, sub_name, data_type)), bbox_inches="tight")
 
 
-def enrichr(dataframe, gene_set_libraries=None, kind="genes"):
+def enrichr(dataframe, gene_set_libraries=None, kind="genes", gmt_dir=os.path.join("metadata", "gene_sets")):
     """
-    Use Enrichr on a list of genes (currently only genes supported through the API).
+    Enrichment of a list of genes in Enrichr gene set libraries, computed locally
+    from their GMT files in `gmt_dir` (see `enrichment.enrich`; only genes are supported).
+    Results have the columns of the Enrichr API results, but "genes" is a ";"-joined
+    string of the overlapping genes instead of a list.
     """
-    import json
-    import requests
-
-    ENRICHR_ADD = 'http://amp.pharm.mssm.edu/Enrichr/addList'
-    ENRICHR_RETRIEVE = 'http://amp.pharm.mssm.edu/Enrichr/enrich'
-    query_string = '?userListId=%s&backgroundType=%s'
+    if kind != "genes":
+        raise ValueError("Only enrichment of genes is supported.")
 
     if gene_set_libraries is None:
         gene_set_libraries = [
@@ -1424,55 +1360,9 @@ def enrichr(dataframe, gene_set_libraries=None, kind="genes"):
             # "TF-LOF_Expression_from_GEO"
         ]
 
-    results = pd.DataFrame()
-    for gene_set_library in gene_set_libraries:
-        print("Using enricher on %s gene set library." % gene_set_library)
-
-        if kind == "genes":
-            # Build payload with bed file
-            attr = "\n".join(dataframe["gene_name"].dropna().tolist())
-        elif kind == "regions":
-            # Build payload with bed file
-            attr = "\n".join(dataframe[['chrom', 'start', 'end']].apply(lambda x: "\t".join([str(i) for i in x]), axis=1).tolist())
-
-        payload = {
-            'list': (None, attr),
-            'description': (None, gene_set_library)
-        }
-        # Request adding gene set
-        response = requests.post(ENRICHR_ADD, files=payload)
-        if not response.ok:
-            raise Exception('Error analyzing gene list')
-
-        # Track gene set ID
-        user_list_id = json.loads(response.text)['userListId']
-
-        # Request enriched sets in gene set
-        response = requests.get(
-            ENRICHR_RETRIEVE + query_string % (user_list_id, gene_set_library)
-        )
-        if not response.ok:
-            raise Exception('Error fetching enrichment results')
-
-        # Get enriched sets in gene set
-        res = json.loads(response.text)
-        # If there's no enrichemnt, continue
-        if len(res) < 0:
-            continue
-
-        # Put in dataframe
-        res = pd.DataFrame([pd.Series(s) for s in res[gene_set_library]])
-        if res.shape[0] == 0:
-            continue
-        res.columns = ["rank", "description", "p_value", "z_score", "combined_score", "genes", "adjusted_p_value"]
-
-        # Remember gene set library used
-        res["gene_set_library"] = gene_set_library
-
-        # Append to master dataframe
-        results = results.append(res, ignore_index=True)
-
-    return results
+    print("Enrichment on gene set libraries: {}".format(", ".join(gene_set_libraries)))
+    index = gene_set_index([gmt_file(gmt_dir, library) for library in gene_set_libraries])
+    return enrich(dataframe["gene_name"], index)
 
 
 def inspect_bulk(df, df_bulk, de_genes, de_genes_bulk):
@@ -1492,7 +1382,7 @@ def inspect_bulk(df, df_bulk, de_genes, de_genes_bulk):
         # derived from bulk
         # derived from scRNA
         for geneset in ["de_genes", "de_genes_bulk"]:
-            g = sns.clustermap(
+            g = clustermap(
                 exp_matrix.ix[eval(geneset)].dropna(),
                 z_score=0,
                 row_cluster=True, col_cluster=True,
@@ -1504,7 +1394,7 @@ def inspect_bulk(df, df_bulk, de_genes, de_genes_bulk):
                 item.set_rotation(90)
             g.fig.savefig(os.path.join("results", "bulk", "bulk_samples.qc.{}.{}.png".format(quant_type, geneset)), dpi=300, bbox_inches="tight")
 
-            g = sns.clustermap(
+            g = clustermap(
                 exp_matrix.ix[eval(geneset)].dropna().corr(),
                 row_cluster=True, col_cluster=True,
                 xticklabels=True, yticklabels=True,
@@ -1675,13 +1565,14 @@ def compare_bulk(df, df_bulk, de_genes, experiment="CROP-seq_Jurkat_TCR", cond1=
     # 2b).
     # CD69, CD82, etc...
     # At gene level or at grna level
+    df_groups, df_bulk_groups = GroupIndex(df), GroupIndex(df_bulk)
     for level in ["gene", "grna"]:
         print(level)
         markers = ["CD69", "CD82", "PDCD1", "CD38", "BCL7A", "CDC20", "TUBB", "ADA", "TUBA1B"]
 
-        sm = df.T.groupby(level=['condition', level]).mean()[markers]
+        sm = df_groups.mean(['condition', level], genes=markers).T
         sm["data_type"] = "single_cell"
-        bm = df_bulk.T.groupby(level=['condition', level]).mean()[markers]
+        bm = df_bulk_groups.mean(['condition', level], genes=markers).T
         # bm = bm.apply(lambda x: (x - x.mean()) / x.std(), axis=0)
         bm["data_type"] = "bulk"
         bm = bm.ix[sm.index].dropna()
@@ -1888,7 +1779,7 @@ def compare_bulk(df, df_bulk, de_genes, experiment="CROP-seq_Jurkat_TCR", cond1=
             variable = (pivot.std() / pivot.sum()).sort_values()
             try:
                 # plot
-                g = sns.clustermap(
+                g = clustermap(
                     pivot[variable.tail(50).index],
                     row_cluster=True, col_cluster=True,
                     xticklabels=True, yticklabels=True,
@@ -1898,7 +1789,7 @@ def compare_bulk(df, df_bulk, de_genes, experiment="CROP-seq_Jurkat_TCR", cond1=
                 for item in g.ax_heatmap.get_xticklabels():
                     item.set_rotation(90)
                 g.savefig(os.path.join("results", "bulk", "enrichr", "enrichr.{}.{}.clustermap.png".format(condition, gene_set_library)), dpi=300, bbox_inches="tight")
-                g = sns.clustermap(
+                g = clustermap(
                     pivot[variable.tail(50).index].T.corr(),
                     row_cluster=True, col_cluster=True,
                     xticklabels=True, yticklabels=True,
@@ -2055,8 +1946,9 @@ def main():
             print(experiment, n_genes)
 
             # Read in digital expression and add pd.MultiIndex with metadata
-            counts_file = os.path.join(results_dir, "{}.digital_expression.{}genes.only_assigned.hdf5.gz".format(experiment, n_genes))
-            exp_assigned = pd.read_hdf(counts_file, "exp_matrix", compression="gzip")
+            # (only assigned cells with at least `n_genes` genes)
+            exp_assigned = read_expression_store(
+                expression_store_file(experiment, results_dir), n_genes=n_genes, only_assigned=True)
             exp_assigned = exp_assigned.T.reset_index()
             exp_assigned['replicate'] = exp_assigned['replicate'].astype(np.int64).astype(str)
             exp_assigned['gene'] = pd.np.nan
@@ -2090,7 +1982,7 @@ def main():
             # Unsupervised analysis
             # apply dimentionality reduction methods/clustering
             # and discover biological axis related with stimulation
-            unsupervised(df, experiment=experiment)
+            unsupervised(df, experiment=experiment, scalable=df.shape[1] > 10000)
             # recover genes most associated with it
             diff = differential_genes(df, method="pca", experiment=experiment)
             de_genes = diff[abs(diff) > np.percentile(abs(diff), 99)].index.tolist()
@@ -2104,7 +1996,7 @@ def main():
             significant_perturbation(df, df_bulk, diff, experiment=experiment)
 
             # visualize signature and make signature position assignments per cell/gRNA/gene
-            stimulation_signature(df, df_bulk, de_genes, experiment=experiment)
+            stimulation_signature(df, df_bulk, de_genes, experiment=experiment, counts=exp_assigned)
 
             # Compare with bulk RNA-seq
             # read in diff genes from bulk
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import argparse
 import os
 import pandas as pd
 import pysam
@@ -9,6 +10,9 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from looper.models import Project
 
+from cell_calling import read_whitelist
+from construct_reads import construct_bam
+
 
 # Set settings
 pd.set_option("date_dayfirst", True)
@@ -353,6 +357,12 @@ def plot_assignments(scores, assignment, coverage):
     plt.close("all")
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--whitelist", action="store_true",
+    help="Keep only cells in the whitelist of cells called for each sample (see cell_calling.py), if any.")
+args = parser.parse_args()
+
 # Start project, add samples
 prj = Project(os.path.join("metadata", "config.yaml"))
 # only used in older versions of looper
@@ -368,12 +378,21 @@ for sample in [s for s in prj.samples if hasattr(s, "replicate")]:  # [s for s i
     sel_guide_annotation = guide_annotation[guide_annotation['library'] == sample.grna_library]
 
     # read in alignments
-    bam = os.path.join(sample.paths.sample_root, "star_gene_exon_tagged.clean.bam")
+    # (construct reads re-aligned to the construct-only reference if available, see construct_reads.py)
+    bam = construct_bam(sample.paths.sample_root)
+    if not os.path.exists(bam):
+        bam = os.path.join(sample.paths.sample_root, "star_gene_exon_tagged.clean.bam")
 
     reads = get_reads_in_construct(bam, sel_guide_annotation)
     reads.to_csv(os.path.join(output_dir, "guide_cell_quantification.csv"), index=False)
     reads = pd.read_csv(os.path.join(output_dir, "guide_cell_quantification.csv"))
 
+    # restrict to called cells, if cells were called from the barcode UMIs
+    if args.whitelist:
+        whitelist = read_whitelist(sample.paths.sample_root)
+        if whitelist is not None:
+            reads = reads[reads['cell'].isin(whitelist)]
+
     # reads in cas9 construct
     cas9_reads = get_reads_in_Cas9_construct(bam)
     cas9_reads.to_csv(os.path.join(output_dir, "cas9_quantification.reads.csv"), index=False)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed cache of reference builds.
+
+Each build is keyed by a hash of everything it is made from (input file contents,
+sequences, configuration). A manifest records the key, artefacts and build time
+of each build so that builds whose key is unchanged and artefacts exist are skipped.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+
+def _file_stat(path):
+    """
+    Size and modification time of a file, to tell whether it changed since its digest was taken.
+    """
+    stat = os.stat(path)
+    return "{}:{}".format(stat.st_size, int(stat.st_mtime))
+
+
+def file_digest(path, manifest=None, chunk_size=2 ** 24):
+    """
+    SHA1 digest of the contents of a file.
+
+    If a manifest is given, digests are remembered in it by file fingerprint
+    (size and modification time) so that unchanged files are not read again.
+    """
+    fingerprint = _file_stat(path)
+    if manifest is not None:
+        known = manifest.setdefault("files", dict()).get(os.path.abspath(path))
+        if known is not None and known["fingerprint"] == fingerprint:
+            return known["digest"]
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+
+    if manifest is not None:
+        manifest["files"][os.path.abspath(path)] = {"fingerprint": fingerprint, "digest": digest}
+    return digest
+
+
+def build_key(*parts):
+    """
+    Hash of the parts a build is made from (strings or JSON-serializable objects).
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True)
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {"builds": dict(), "files": dict()}
+    with open(manifest_file, "r") as handle:
+        return json.load(handle)
+
+
+def write_manifest(manifest, manifest_file):
+    # write to a temporary file first so that an interrupted write does not lose the manifest
+    with open(manifest_file + ".tmp", "w") as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    os.rename(manifest_file + ".tmp", manifest_file)
+
+
+def is_built(manifest, name, key):
+    """
+    Whether build `name` exists with key `key` and all its artefacts are present.
+    """
+    build = manifest["builds"].get(name)
+    if build is None or build["key"] != key:
+        return False
+    return all(os.path.exists(path) for path in build["artefacts"].values())
+
+
+def record_build(manifest, manifest_file, name, key, artefacts, build_time):
+    """
+    Record a finished build in the manifest and save it.
+
+    :param artefacts: dict of artefact name: path.
+    :param build_time: duration of the build in seconds.
+    """
+    manifest["builds"][name] = {
+        "key": key,
+        "artefacts": artefacts,
+        "built": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "build_time_seconds": round(build_time, 1)}
+    write_manifest(manifest, manifest_file)
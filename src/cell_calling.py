@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+Calling of cells from the number of UMIs of each cell barcode.
+
+Barcodes are ranked by total UMIs and cells are those above the inflection
+(or the knee) of the log-log rank curve. Optionally, barcodes below that threshold
+whose expression profile departs from the ambient RNA profile (estimated from
+barcodes with very few UMIs) are rescued as cells.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+def barcode_totals(molecules):
+    """
+    Total UMIs of each cell barcode from a table of (cell, gene, UMI) molecules
+    (see `digital_expression.count_molecules`).
+    """
+    codes, barcodes = pd.factorize(molecules["cell"])
+    return pd.Series(np.bincount(codes, minlength=len(barcodes)), index=barcodes, name="umis")
+
+
+def knee_point(totals, min_umis=10):
+    """
+    UMI threshold at the knee of the log-log curve of barcodes ranked by total UMIs:
+    the point of the curve furthest from the line joining its ends.
+
+    :param min_umis: barcodes with fewer UMIs are not considered.
+    """
+    counts = np.sort(np.asarray(totals, dtype=np.float64))[::-1]
+    counts = counts[counts >= min_umis]
+    if len(counts) < 3:
+        return counts.min() if len(counts) > 0 else min_umis
+
+    x = np.log10(np.arange(1, len(counts) + 1))
+    y = np.log10(counts)
+    # distance of each point to the line joining first and last points
+    dx, dy = x[-1] - x[0], y[-1] - y[0]
+    distance = np.abs(dy * (x - x[0]) - dx * (y - y[0])) / np.hypot(dx, dy)
+    return counts[np.argmax(distance)]
+
+
+def inflection_point(totals, min_umis=10):
+    """
+    UMI threshold at the inflection of the log-log curve of barcodes ranked by total UMIs:
+    the point of steepest descent.
+    """
+    counts = np.sort(np.asarray(totals, dtype=np.float64))[::-1]
+    counts = counts[counts >= min_umis]
+    if len(counts) < 3:
+        return counts.min() if len(counts) > 0 else min_umis
+
+    # collapse ties so that the slope is computed between distinct UMI totals
+    values, first = np.unique(counts[::-1], return_index=True)
+    if len(values) < 3:
+        print("Fewer than 3 distinct UMI totals, using the knee point instead of the inflection point.")
+        return knee_point(counts, min_umis)
+    ranks = len(counts) - first
+    slope = np.diff(np.log10(values)) / np.diff(np.log10(ranks))
+    return values[np.argmin(slope) + 1]
+
+
+def ambient_test(matrix, totals, ambient_umis=100, pseudocount=1e-4):
+    """
+    Test the expression profile of each barcode against the ambient RNA profile.
+
+    The ambient profile is estimated from barcodes with at most `ambient_umis` UMIs.
+    The multinomial log-likelihood of each barcode under the ambient profile is
+    compared with its expectation and variance for a barcode with the same number
+    of UMIs sampled from the ambient profile.
+
+    :param matrix: barcodes x genes sparse matrix of UMI counts.
+    :param totals: total UMIs of each barcode (rows of `matrix`).
+    :returns: z-score of each barcode (strongly negative for barcodes unlike ambient RNA).
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    totals = np.asarray(totals, dtype=np.float64)
+
+    ambient = np.asarray(matrix[totals <= ambient_umis].sum(axis=0), dtype=np.float64).ravel() + pseudocount
+    ambient /= ambient.sum()
+    log_ambient = np.log(ambient)
+
+    log_likelihood = matrix.dot(log_ambient)
+    mean = totals * (ambient * log_ambient).sum()
+    var = totals * ((ambient * log_ambient ** 2).sum() - (ambient * log_ambient).sum() ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(var > 0, (log_likelihood - mean) / np.sqrt(var), 0.)
+
+
+def call_cells(totals, matrix=None, method="inflection", min_umis=10, ambient_umis=100, max_z=-10):
+    """
+    Call cells from the total UMIs of each barcode.
+
+    :param totals: pd.Series of total UMIs indexed by barcode.
+    :param method: threshold on the rank curve, "inflection" or "knee".
+    :param matrix: barcodes x genes sparse matrix of UMI counts (rows as `totals`).
+                   If given, barcodes between `ambient_umis` and the threshold with a
+                   profile unlike the ambient RNA (z-score below `max_z`) are also cells.
+    :returns: pd.Index of barcodes called as cells.
+    """
+    threshold = {"inflection": inflection_point, "knee": knee_point}[method](totals.values, min_umis=min_umis)
+    cells = totals.values >= threshold
+
+    if matrix is not None:
+        z = ambient_test(matrix, totals.values, ambient_umis=ambient_umis)
+        cells |= (totals.values > ambient_umis) & (z < max_z)
+
+    return totals.index[cells]
+
+
+def whitelist_file(sample_root):
+    return os.path.join(sample_root, "cell_whitelist.txt")
+
+
+def write_whitelist(cells, sample_root):
+    pd.Series(cells).to_csv(whitelist_file(sample_root), index=False, header=False)
+
+
+def read_whitelist(sample_root):
+    """
+    Read the barcodes of cells called for a sample (None if cells were not called).
+    """
+    if not os.path.exists(whitelist_file(sample_root)):
+        return None
+    with open(whitelist_file(sample_root), "r") as handle:
+        cells = [line.strip() for line in handle if line.strip() != ""]
+    if len(cells) == 0:
+        print("No cells called in {}.".format(whitelist_file(sample_root)))
+    return pd.Index(cells, dtype=object)
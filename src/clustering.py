@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Hierarchical clustering of heatmaps, computed once per data.
+
+`clustermap` is a drop-in replacement for `seaborn.clustermap` that computes the row and
+column linkages itself, on the data as scaled by seaborn, and passes them on precomputed.
+Linkages are kept in memory by fingerprint of the data, metric and method (and on disk,
+see `memoize`), so repeated figures of the same matrix, or of both axes of a symmetric
+matrix such as a correlation matrix, are clustered only once.
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.cluster.hierarchy
+
+from memoize import fingerprint, memoize
+
+
+# linkages by fingerprint of data, metric and method
+_linkages = dict()
+
+
+def scale(data, z_score=None, standard_scale=None):
+    """
+    Data as scaled by `seaborn.clustermap` before clustering: rows (0) or columns (1)
+    z-scored or scaled to the 0-1 range.
+    """
+    data = pd.DataFrame(data)
+    if z_score is not None:
+        data = data if z_score == 1 else data.T
+        data = (data - data.mean()) / data.std()
+        data = data if z_score == 1 else data.T
+    elif standard_scale is not None:
+        data = data if standard_scale == 1 else data.T
+        data = (data - data.min()) / (data.max() - data.min())
+        data = data if standard_scale == 1 else data.T
+    return data
+
+
+@memoize
+def _linkage(values, metric, method):
+    return scipy.cluster.hierarchy.linkage(values, method=method, metric=metric)
+
+
+def linkage(values, metric="euclidean", method="average"):
+    """
+    Linkage of the rows of a matrix, computed once per matrix, metric and method.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    key = fingerprint(values, metric, method)
+    if key not in _linkages:
+        _linkages[key] = _linkage(values, metric, method)
+    return _linkages[key]
+
+
+def clustermap(
+        data, metric="euclidean", method="average", z_score=None, standard_scale=None,
+        row_cluster=True, col_cluster=True, **kwargs):
+    """
+    `seaborn.clustermap` with cached row and column linkages.
+    """
+    import seaborn as sns
+
+    scaled = scale(data, z_score, standard_scale)
+    if row_cluster and kwargs.get("row_linkage") is None:
+        kwargs["row_linkage"] = linkage(scaled.values, metric, method)
+    if col_cluster and kwargs.get("col_linkage") is None:
+        kwargs["col_linkage"] = linkage(scaled.values.T, metric, method)
+    return sns.clustermap(
+        data, metric=metric, method=method, z_score=z_score, standard_scale=standard_scale,
+        row_cluster=row_cluster, col_cluster=col_cluster, **kwargs)
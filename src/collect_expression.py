@@ -1,71 +1,192 @@
 #!/usr/bin/env python
 
 from looper.models import Project
+import argparse
 import os
+import numpy as np
 import pandas as pd
-
-
-def collect_bitseq_output(samples):
-    first = True
-    for i, sample in enumerate(samples):
-        if first:
-            try:
-                # read the "tr" file of one sample to get indexes
-                tr = pd.read_csv(
-                    os.path.join(
-                        sample.paths.sample_root, "bowtie1_{}".format(sample.transcriptome),
-                        "bitSeq",
-                        sample.name + ".tr"),
-                    sep=" ", header=None, skiprows=1,
-                    names=["ensembl_gene_id", "ensembl_transcript_id", "v1", "v2"])
-            except IOError:
-                print("Sample {} is missing.".format(sample.name))
-                continue
-            # add id index
-            tr.set_index("ensembl_gene_id", append=False, inplace=True)
-            tr.set_index("ensembl_transcript_id", append=True, inplace=True)
-            # create dataframe
-            expr = pd.DataFrame(index=tr.index)
-            first = False
-
-        # load counts
-        try:
-            counts = pd.read_csv(os.path.join(
-                sample.paths.sample_root, "bowtie1_{}".format(sample.transcriptome),
-                "bitSeq",
-                sample.name + ".counts"), sep=" ")
-        except IOError:
-            print("Sample {} is missing.".format(sample.name))
-            continue
-        counts.index = expr.index
-
-        # Append
-        expr[sample.name] = counts
-
-    return expr
-
-
-def collect_ESAT_output(samples):
-    first = True
-    for i, sample in enumerate(samples):
-        try:
-            counts = pd.read_csv(
-                os.path.join(
-                    sample.paths.sample_root, "ESAT_{}".format(sample.genome), sample.name + ".gene.txt"),
-                sep="\t", header=None, skiprows=1,
-                names=["gene_name", "chr", "strand", sample.name]).set_index("gene_name")[sample.name]
-        except IOError:
-            print("Sample {} is missing.".format(sample.name))
-            continue
-        # add gene index
-        if first:
-            expr = pd.DataFrame(counts)
-            first = False
+from multiprocessing.pool import ThreadPool
+
+from expression_store import (
+    expression_store_file, sample_expression_file, file_fingerprint, read_sample_expression,
+    stored_samples, append_sample_to_store, remove_sample_from_store, update_store_assignments)
+from cell_calling import read_whitelist
+from genome_annotation import gene_name_mapping, map_gene_names
+
+
+def bitseq_files(sample):
+    output_dir = os.path.join(sample.paths.sample_root, "bowtie1_{}".format(sample.transcriptome), "bitSeq")
+    return os.path.join(output_dir, sample.name + ".tr"), os.path.join(output_dir, sample.name + ".counts")
+
+
+def read_bitseq_counts(sample):
+    """
+    Read the BitSeq transcript counts of a sample as an array (None if missing).
+    """
+    try:
+        return pd.read_csv(bitseq_files(sample)[1], sep=" ").iloc[:, 0].values
+    except IOError:
+        print("Sample {} is missing.".format(sample.name))
+        return None
+
+
+def read_ESAT_counts(sample):
+    """
+    Read the ESAT gene counts of a sample as a pd.Series indexed by gene name (None if missing).
+    """
+    try:
+        return pd.read_csv(
+            os.path.join(
+                sample.paths.sample_root, "ESAT_{}".format(sample.genome), sample.name + ".gene.txt"),
+            sep="\t", header=None, skiprows=1,
+            names=["gene_name", "chr", "strand", sample.name]).set_index("gene_name")[sample.name]
+    except IOError:
+        print("Sample {} is missing.".format(sample.name))
+        return None
+
+
+def read_concurrently(function, samples, n_threads=8):
+    pool = ThreadPool(n_threads)
+    results = pool.map(function, samples)
+    pool.close()
+    pool.join()
+    return results
+
+
+def collect_bitseq_output(samples, n_threads=8):
+    """
+    Collect the BitSeq transcript counts of several samples into a transcripts x samples matrix.
+    Counts are read concurrently and filled into a preallocated array.
+    """
+    counts = read_concurrently(read_bitseq_counts, samples, n_threads)
+    found = [i for i, c in enumerate(counts) if c is not None]
+
+    # read the "tr" file of one sample to get indexes
+    tr = pd.read_csv(
+        bitseq_files(samples[found[0]])[0],
+        sep=" ", header=None, skiprows=1,
+        names=["ensembl_gene_id", "ensembl_transcript_id", "v1", "v2"])
+    index = pd.MultiIndex.from_arrays(
+        [tr["ensembl_gene_id"], tr["ensembl_transcript_id"]], names=["ensembl_gene_id", "ensembl_transcript_id"])
+
+    matrix = np.empty((len(index), len(found)), dtype=np.float64)
+    for j, i in enumerate(found):
+        matrix[:, j] = counts[i]
+
+    return pd.DataFrame(matrix, index=index, columns=[samples[i].name for i in found])
+
+
+def collect_ESAT_output(samples, n_threads=8):
+    """
+    Collect the ESAT gene counts of several samples into a genes x samples matrix,
+    on the genes of the first sample found.
+    Counts are read concurrently and filled into a preallocated array.
+    """
+    counts = read_concurrently(read_ESAT_counts, samples, n_threads)
+    found = [i for i, c in enumerate(counts) if c is not None]
+
+    index = counts[found[0]].index
+    matrix = np.empty((len(index), len(found)), dtype=np.float64)
+    for j, i in enumerate(found):
+        if counts[i].index.equals(index):
+            matrix[:, j] = counts[i].values
         else:
-            expr[sample.name] = counts
-
-    return expr
-
+            matrix[:, j] = counts[i].reindex(index).values
+
+    return pd.DataFrame(matrix, index=index, columns=[samples[i].name for i in found])
+
+
+def annotate_bulk_samples(count_matrix, samples):
+    """
+    Add the metadata of the samples to the columns of a count matrix.
+    """
+    by_name = {sample.name: sample for sample in samples}
+    compl_samples = [by_name[c] for c in count_matrix.columns]
+    count_matrix.columns = pd.MultiIndex.from_arrays(
+        [[sample.name for sample in compl_samples],
+         [sample.condition for sample in compl_samples],
+         [sample.gene for sample in compl_samples],
+         [sample.grna for sample in compl_samples]],
+        names=["sample_name", "condition", "gene", "grna"])
+    return count_matrix
+
+
+def max_by_group(count_matrix, level):
+    """
+    Reduce the rows of a count matrix to the maximum within each value of an index level.
+    Equivalent to `count_matrix.groupby(level=level).max()` on a single sorted reduction.
+    """
+    codes, groups = pd.factorize(count_matrix.index.get_level_values(level), sort=True)
+    order = np.argsort(codes, kind="mergesort")
+    sorted_codes = codes[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_codes)) + 1])
+    reduced = np.maximum.reduceat(count_matrix.values[order], starts, axis=0)
+    return pd.DataFrame(reduced, index=pd.Index(groups, name=level), columns=count_matrix.columns)
+
+
+def grna_table_file(experiment, name, results_dir="results"):
+    basename = {
+        "reads": "guide_cell_gRNA_assignment",
+        "scores": "guide_cell_scores",
+        "assignment": "guide_cell_assignment"}[name]
+    return os.path.join(results_dir, "{}.{}.all.hdf5".format(experiment, basename))
+
+
+def read_grna_tables(sample_name):
+    """
+    Read the gRNA reads quantification, scores and assignment of a sample (None if missing).
+    """
+    output_dir = os.path.join("results_pipeline", sample_name, "gRNA_assignment")
+    try:
+        return [
+            pd.read_csv(os.path.join(output_dir, table))
+            for table in ["guide_cell_quantification.csv", "guide_cell_scores.csv", "guide_cell_assignment.csv"]]
+    except IOError:
+        return None
+
+
+def gather_grna_tables(experiment, rows, n_threads=8):
+    """
+    Gather the gRNA reads, scores and assignment tables of all samples of an experiment.
+    Tables of each sample are read concurrently and concatenated once,
+    with the sample metadata added as categorical columns.
+    """
+    pool = ThreadPool(n_threads)
+    tables = pool.map(read_grna_tables, rows["sample_name"].tolist())
+    pool.close()
+    pool.join()
+
+    found = [i for i, t in enumerate(tables) if t is not None]
+    if len(found) == 0:
+        return None
+    metadata = rows.iloc[found]
+    for i in found:
+        print("Sample {} has {} cells assigned".format(rows["sample_name"].iloc[i], tables[i][2].shape[0]))
+
+    gathered = list()
+    for j in range(3):
+        table = pd.concat([tables[i][j] for i in found], ignore_index=True)
+        # index of the sample of origin of each row
+        origin = np.repeat(np.arange(len(found)), [tables[i][j].shape[0] for i in found])
+        for column, values in [
+                ("sample", metadata["sample_name"]),
+                ("experiment", pd.Series([experiment] * len(found))),
+                ("condition", metadata["condition"]),
+                ("replicate", metadata["replicate"])]:
+            categories = pd.Categorical(values.values)
+            table[column] = pd.Categorical.from_codes(categories.codes[origin], categories.categories)
+        gathered.append(table)
+    return gathered
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--append", action="store_true",
+    help="Add only new or changed samples to existing expression stores instead of rebuilding them.")
+parser.add_argument(
+    "--whitelist", action="store_true",
+    help="Keep only cells in the whitelist of cells called for each sample (see cell_calling.py), if any.")
+args = parser.parse_args()
 
 prj = Project(os.path.join("metadata", "config.yaml"))
 # for older looper versions:
@@ -78,130 +199,115 @@ guide_annotation = pd.read_csv(os.path.join("metadata", "guide_annotation.csv"))
 
 # Gather gRNA assignment info across all samples used
 for experiment, rows in prj.sheet.groupby(['experiment']):
-    # merge gRNA data
-    reads = pd.DataFrame()
-    scores = pd.DataFrame()
-    assignment = pd.DataFrame()
-
-    for sample_name in rows["sample_name"]:
-        print(experiment, sample_name)
-        try:
-            r = pd.read_csv(os.path.join("results_pipeline", sample_name, "gRNA_assignment", "guide_cell_assignment.csv"))
-            s = pd.read_csv(os.path.join("results_pipeline", sample_name, "gRNA_assignment", "guide_cell_scores.csv"))
-            a = pd.read_csv(os.path.join("results_pipeline", sample_name, "gRNA_assignment", "guide_cell_assignment.csv"))
-        except IOError:
-            continue
-        r['sample'] = s['sample'] = a['sample'] = sample_name
-        r['experiment'] = s['experiment'] = a['experiment'] = experiment
-        r['condition'] = s['condition'] = a['condition'] = rows.loc[rows["sample_name"] == sample_name, 'condition'].squeeze()
-        r['replicate'] = s['replicate'] = a['replicate'] = rows.loc[rows["sample_name"] == sample_name, 'replicate'].squeeze()
-        reads = reads.append(r)
-        scores = scores.append(s)
-        assignment = assignment.append(a)
-        print("Sample {} has {} cells assigned".format(sample_name, a.shape[0]))
-        print("Total: {}".format(assignment.shape[0]))
+    print(experiment)
+    tables = gather_grna_tables(experiment, rows)
+    if tables is None:
+        continue
+    reads, scores, assignment = tables
+    print("Total: {} cells assigned".format(assignment.shape[0]))
 
     # group gRNAs per gene or control group
     assignment = pd.merge(assignment, guide_annotation, left_on='assignment', right_on='oligo_name')
 
-    reads.to_csv(os.path.join(results_dir, "{}.guide_cell_gRNA_assignment.all.csv".format(experiment)), index=False)
-    scores.to_csv(os.path.join(results_dir, "{}.guide_cell_scores.all.csv".format(experiment)), index=False)
-    assignment.to_csv(os.path.join(results_dir, "{}.guide_cell_assignment.all.csv".format(experiment)), index=False)
+    for table, name in [(reads, "reads"), (scores, "scores"), (assignment, "assignment")]:
+        table.to_hdf(grna_table_file(experiment, name, results_dir), name, format="table", complevel=9, complib="zlib")
 
 
 # Gather transcriptome across all samples used and annotate with gRNA info
-for n_genes in [500]:
-    print("Merging...")
-    print("n_genes", "experiment", "i", "sample.name", "sample.condition", "sample.replicate:")
-    for experiment, rows in prj.sheet.groupby(['experiment']):
-        if experiment == "CROP-seq_HEK_test":
+# Expression is collected only at the most permissive gene threshold, higher thresholds
+# are applied when reading the store (see `read_expression_store`)
+# With `--append`, samples already in the store with unchanged input are not read again,
+# only their gRNA assignments are updated.
+print("Merging...")
+print("experiment", "i", "sample.name", "sample.condition", "sample.replicate:")
+for experiment, rows in prj.sheet.groupby(['experiment']):
+    if experiment == "CROP-seq_HEK_test":
+        continue
+    assignment = pd.read_hdf(grna_table_file(experiment, "assignment", results_dir), "assignment")
+
+    store_file = expression_store_file(experiment, results_dir)
+    if not args.append and os.path.exists(store_file):
+        os.remove(store_file)
+    stored = stored_samples(store_file)
+    samples = [q for q in prj.samples if q.name in rows["sample_name"].tolist() and hasattr(q, "replicate") and hasattr(q, "condition")]
+
+    # samples no longer in the annotation
+    for sample_name in sorted(set(stored) - set(q.name for q in samples)):
+        print("Sample {} not in annotation anymore, removing it.".format(sample_name))
+        remove_sample_from_store(store_file, sample_name)
+
+    # merge expression
+    unchanged = dict()
+    for i, sample in enumerate(samples):
+        print(experiment, i, sample.name, sample.condition, sample.replicate)
+        try:
+            fingerprint = file_fingerprint(sample_expression_file(sample.paths.sample_root))
+        except OSError:
+            continue
+
+        # get gRNA assignment filtered for concordance ratio
+        ass = assignment.loc[
+            (assignment['concordance_ratio'] >= 0.9) &
+            (assignment['experiment'] == experiment) &
+            (assignment['condition'] == sample.condition) &
+            (assignment['replicate'].astype(str) == str(sample.replicate)),
+            ['cell', 'assignment']].set_index("cell")['assignment']
+
+        if stored.get(sample.name) == fingerprint:
+            print("Sample {} already in store.".format(sample.name))
+            unchanged[sample.name] = ass
+            continue
+        if sample.name in stored:
+            print("Input of sample {} changed, replacing it.".format(sample.name))
+            remove_sample_from_store(store_file, sample.name)
+
+        # read in
+        try:
+            exp = read_sample_expression(sample.paths.sample_root)
+        except IOError:
             continue
-        reads = pd.read_csv(os.path.join(results_dir, "{}.guide_cell_gRNA_assignment.all.csv".format(experiment)))
-        scores = pd.read_csv(os.path.join(results_dir, "{}.guide_cell_scores.all.csv".format(experiment)))
-        assignment = pd.read_csv(os.path.join(results_dir, "{}.guide_cell_assignment.all.csv".format(experiment)))
-
-        # merge expression
-        exp_all = pd.DataFrame()
-        for i, sample in enumerate([q for q in prj.samples if q.name in rows["sample_name"].tolist() and hasattr(q, "replicate") and hasattr(q, "condition")]):
-            print(n_genes, experiment, i, sample.name, sample.condition, sample.replicate)
-            # read in
-            try:
-                exp = pd.read_csv(os.path.join(sample.paths.sample_root, "digital_expression.{}genes.tsv".format(n_genes)), sep="\t").set_index("GENE")
-            except IOError:
-                continue
-
-            # get gRNA assignment filtered for concordance ratio
-            ass = assignment.loc[
-                (assignment['concordance_ratio'] >= 0.9) &
-                (assignment['experiment'] == experiment) &
-                (assignment['condition'] == sample.condition) &
-                (assignment['replicate'].astype(str) == str(sample.replicate)),
-                ['cell', 'assignment']].set_index("cell").squeeze()
-
-            print("{}% unassigned cells".format(ass.ix[exp.columns].isnull().sum() / float(exp.shape[1]) * 100))
-
-            # add info as multiindex columns
-            arrays = [[sample.condition for _ in range(exp.shape[1])], [sample.replicate for _ in range(exp.shape[1])], exp.columns.tolist(), ass.ix[exp.columns].tolist()]
-            exp.columns = pd.MultiIndex.from_tuples(list(zip(*arrays)), names=['condition', 'replicate', 'cell', 'grna'])
-
-            print("loaded. Shape: ", exp.shape)
-            if i == 0:
-                exp_all = exp
-            else:
-                # get union of indices
-                new_index = pd.np.unique(sorted(exp_all.index.tolist() + exp.index.tolist()))
-                # concatenate
-                exp_all = pd.concat([exp_all.reindex(new_index), exp.reindex(new_index)], axis=1).fillna(0)
-
-            print(sample.name, exp_all.shape)
-        print("saving big")
-
-        # save only assigned cells
-        exp_all_assigned = exp_all[exp_all.columns[~pd.isnull(exp_all.columns.get_level_values('grna'))]]
-        exp_all_assigned.to_hdf(os.path.join(results_dir, "{}.digital_expression.{}genes.only_assigned.hdf5.gz".format(experiment, n_genes)), "exp_matrix", compression="gzip")
-
-        # exp_all = exp_all.to_sparse(fill_value=0)
-        exp_all.to_csv(os.path.join(results_dir, "{}.digital_expression.{}genes.csv.gz".format(experiment, n_genes)), index=True, header=None, compression="gzip")
-        # exp_all.to_pickle(os.path.join(results_dir, "{}.digital_expression.{}genes.pickle".format(experiment, n_genes)))
-        exp_all.to_hdf(os.path.join(results_dir, "{}.digital_expression.{}genes.hdf5.gz".format(experiment, n_genes)), "exp_matrix", compression="gzip")
+        if args.whitelist:
+            whitelist = read_whitelist(sample.paths.sample_root)
+            if whitelist is not None:
+                exp = exp.loc[:, exp.columns.isin(whitelist)]
+        ass = ass.reindex(exp.columns)
+
+        print("{}% unassigned cells".format(ass.isnull().sum() / float(exp.shape[1]) * 100))
+
+        # add cells with their metadata to the store
+        cells = pd.DataFrame({
+            "sample": sample.name,
+            "condition": sample.condition,
+            "replicate": str(sample.replicate),
+            "cell": exp.columns,
+            "grna": ass.values})
+        append_sample_to_store(store_file, exp, cells, sample.name, fingerprint)
+
+        print("loaded. Shape: ", exp.shape)
+
+    # update gRNA assignments of samples already collected
+    if len(unchanged) > 0:
+        update_store_assignments(store_file, unchanged)
 
 
 # Collect bulk RNA-seq data
+# Ensembl gene ID to gene name mapping, built from the GTF annotation of the spiked genomes (see guides_to_ref.py)
+gene_names = gene_name_mapping(os.path.join(prj.output_dir, "spiked_genomes", "Homo_sapiens.GRCh38.77.gene_names.csv"))
+
 for experiment in prj.sheet['experiment'].drop_duplicates().dropna():
     samples = [sample for sample in prj.samples if hasattr(sample, "experiment")]
     samples = [sample for sample in samples if sample.experiment == experiment and sample.library == "SMART-seq"]
     # Collect transcript counts for Bulk samples
-    count_matrix = collect_bitseq_output(samples)
-
-    # Add metadata
-    compl_samples = [[sample for sample in samples if sample.name == c][0] for c in count_matrix.columns]
-    condition = [sample.condition for sample in compl_samples]
-    gene = [sample.gene for sample in compl_samples]
-    grna = [sample.grna for sample in compl_samples]
-    count_matrix.columns = pd.MultiIndex.from_arrays([[sample.name for sample in compl_samples], condition, gene, grna], names=["sample_name", "condition", "gene", "grna"])
+    count_matrix = annotate_bulk_samples(collect_bitseq_output(samples), samples)
 
     # Map ensembl gene IDs to gene names
-    import requests
-    url_query = "".join([
-        """http://ensembl.org/biomart/martservice?query=""",
-        """<?xml version="1.0" encoding="UTF-8"?>""",
-        """<!DOCTYPE Query>""",
-        """<Query  virtualSchemaName = "default" formatter = "CSV" header = "0" uniqueRows = "0" count = "" datasetConfigVersion = "0.6" >""",
-        """<Dataset name = "hsapiens_gene_ensembl" interface = "default" >""",
-        """<Attribute name = "ensembl_gene_id" />""",
-        """<Attribute name = "external_gene_name" />""",
-        """</Dataset>""",
-        """</Query>"""])
-    req = requests.get(url_query, stream=True)
-    mapping = pd.DataFrame((x.strip().split(",") for x in list(req.iter_lines())), columns=["ensembl_gene_id", "gene_name"]).set_index("ensembl_gene_id").to_dict()['gene_name']
-    index = count_matrix.index.get_level_values('ensembl_gene_id').str.replace("\..*", "")
-    genes = [mapping[g] for g in index[index.isin(mapping.keys())]]
-
-    count_matrix = count_matrix[index.isin(mapping.keys())]
+    genes, known = map_gene_names(count_matrix.index.get_level_values('ensembl_gene_id'), gene_names)
+
+    count_matrix = count_matrix[known]
     count_matrix.index = pd.MultiIndex.from_arrays([genes, count_matrix.index.get_level_values('ensembl_gene_id')], names=['gene_name', "ensembl_transcript_id"])
 
     # Reduce to gene-level measurements by max of transcripts
-    count_matrix_gene = count_matrix.groupby(level=["gene_name"]).max()
+    count_matrix_gene = max_by_group(count_matrix, "gene_name")
 
     # save
     count_matrix.to_csv(os.path.join("results", "{}.count_matrix.transcript_level.csv".format(experiment)))
@@ -210,13 +316,7 @@ for experiment in prj.sheet['experiment'].drop_duplicates().dropna():
     # Get ESAT count matrix
     samples = [sample for sample in prj.samples if hasattr(sample, "experiment")]
     samples = [sample for sample in samples if sample.experiment == experiment and sample.library == "rnaESAT"]
-    count_matrix = collect_ESAT_output(samples).sort_index()
-
-    compl_samples = [[sample for sample in samples if sample.name == c][0] for c in count_matrix.columns]
-    condition = [sample.condition for sample in compl_samples]
-    gene = [sample.gene for sample in compl_samples]
-    grna = [sample.grna for sample in compl_samples]
-    count_matrix.columns = pd.MultiIndex.from_arrays([[sample.name for sample in compl_samples], condition, gene, grna], names=["sample_name", "condition", "gene", "grna"])
+    count_matrix = annotate_bulk_samples(collect_ESAT_output(samples).sort_index(), samples)
 
     # save
     count_matrix.to_csv(os.path.join("results", "{}.ESAT_count_matrix.csv".format(experiment)))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+Fast re-alignment of CROP-seq construct reads.
+
+Reads sharing k-mers with the U6 promoter, gRNA backbone or Cas9 construct
+(from `config['crop-seq']`) are pulled from a sample's alignments and aligned to
+the construct-only reference of its gRNA library built by guides_to_ref.py,
+without loading the genome. Cell and molecule barcodes are carried in the read
+names through the alignment and restored as `XC`/`XM` tags, so that the output
+can be used for gRNA assignment in place of the genome alignments.
+K-mers are encoded as 2-bit integers and looked up for batches of reads at once,
+and the filtering and alignment of each sample run in one job.
+"""
+
+import argparse
+import gzip
+import os
+from functools import partial
+import numpy as np
+import pysam
+from looper.models import Project
+
+from job_executor import Executor, Job, LocalBackend
+
+
+star = "/cm/shared/apps/star/2.4.2a/STAR"
+
+complement = {"A": "T", "C": "G", "G": "C", "T": "A", "N": "N"}
+
+# 2-bit code of each base (byte), 4 for other characters
+base_codes = np.full(256, 4, dtype=np.uint8)
+base_codes[np.frombuffer(b"ACGTacgt", dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+
+def reverse_complement(sequence):
+    return "".join(complement.get(base, "N") for base in reversed(sequence))
+
+
+def construct_sequences(config):
+    """
+    Sequences of the CROP-seq constructs shared by all gRNAs.
+    """
+    return [
+        config['crop-seq']['u6'],
+        config['crop-seq']['rest'],
+        "".join([config['crop-seq'][k] for k in ["cas9", "nls", "flag", "p2a", "blast", "space", "virus_ltr"]])]
+
+
+def construct_kmers(config, k=16):
+    """
+    Set of k-mers (in both orientations) of the CROP-seq constructs.
+    """
+    kmers = set()
+    for sequence in construct_sequences(config):
+        for s in [sequence.upper(), reverse_complement(sequence.upper())]:
+            kmers.update(s[i:i + k] for i in range(len(s) - k + 1))
+    return kmers
+
+
+def encode_kmers(sequence, k=16):
+    """
+    2-bit integer codes of the k-mers (k <= 32) starting at each position of a sequence.
+
+    :returns: tuple of np.uint64 codes and whether each k-mer has only A, C, G and T.
+    """
+    bases = base_codes[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+    n = len(bases) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+    # codes of k-mers of doubling width, then extended one base at a time
+    codes, width = (bases & 3).astype(np.uint64), 1
+    while 2 * width <= k:
+        codes = (codes[:-width] << np.uint64(2 * width)) | codes[width:]
+        width *= 2
+    while width < k:
+        codes = (codes[:-1] << np.uint64(2)) | (bases[width:] & 3)
+        width += 1
+    other = np.concatenate([[0], np.cumsum(bases == 4)])
+    return codes, other[k:] == other[:n]
+
+
+def kmer_table(kmers, k=16):
+    """
+    Sorted codes of a set of k-mers (see `encode_kmers`).
+    """
+    codes, valid = encode_kmers("N".join(kmers), k)
+    return np.unique(codes[valid])
+
+
+def shares_kmer(sequences, table, k=16):
+    """
+    Whether each of a list of sequences has a k-mer in `table` (see `kmer_table`).
+    Sequences are joined with N so that the k-mers of all are encoded at once.
+    """
+    found = np.zeros(len(sequences), dtype=bool)
+    if len(sequences) == 0 or len(table) == 0:
+        return found
+    starts = np.cumsum([0] + [len(s) + 1 for s in sequences[:-1]])
+    codes, valid = encode_kmers("N".join(sequences), k)
+    # only k-mers whose lowest 20 bits match those of a k-mer of the table are searched in it
+    mask = np.uint64((1 << 20) - 1)
+    buckets = np.zeros(1 << 20, dtype=bool)
+    buckets[(table & mask).astype(np.int64)] = True
+    candidates = np.flatnonzero(valid & buckets[(codes & mask).astype(np.int64)])
+    nearest = table[np.minimum(np.searchsorted(table, codes[candidates]), len(table) - 1)]
+    positions = candidates[nearest == codes[candidates]]
+    found[np.searchsorted(starts, positions, side="right") - 1] = True
+    return found
+
+
+def construct_dir(output_dir, library):
+    return os.path.join(output_dir, "constructs_" + library)
+
+
+def filter_construct_reads(bam_file, output_fastq, kmers, k=16, batch_size=100000):
+    """
+    Write reads of a tagged BAM file (mapped or not) sharing k-mers with the constructs to a FASTQ file,
+    with their cell (`XC`) and molecule (`XM`) barcodes appended to the read name.
+
+    :param batch_size: number of reads whose k-mers are looked up at once.
+    :returns: number of reads written.
+    """
+    table = kmer_table(kmers, k)
+    n = 0
+    with pysam.AlignmentFile(bam_file, check_sq=False) as bam, gzip.open(output_fastq, "wt") as fastq:
+        names, sequences, qualities = list(), list(), list()
+
+        def write_batch():
+            found = np.flatnonzero(shares_kmer(sequences, table, k))
+            for i in found:
+                fastq.write("@{}\n{}\n+\n{}\n".format(names[i], sequences[i], qualities[i]))
+            del names[:], sequences[:], qualities[:]
+            return len(found)
+
+        for aln in bam.fetch(until_eof=True):
+            if aln.is_secondary or aln.is_supplementary or aln.query_sequence is None:
+                continue
+            if not (aln.has_tag("XC") and aln.has_tag("XM")):
+                continue
+            sequence = aln.query_sequence
+            if aln.query_qualities is None:
+                quality = "I" * len(sequence)
+            else:
+                quality = pysam.qualities_to_qualitystring(aln.query_qualities)
+            # original read orientation
+            if aln.is_reverse:
+                sequence, quality = reverse_complement(sequence), quality[::-1]
+            names.append("{}|{}|{}".format(aln.query_name, aln.get_tag("XC"), aln.get_tag("XM")))
+            sequences.append(sequence)
+            qualities.append(quality)
+            if len(sequences) >= batch_size:
+                n += write_batch()
+        n += write_batch()
+    print("{}: {} candidate construct reads".format(bam_file, n))
+    return n
+
+
+def restore_tags(input_bam, output_bam):
+    """
+    Move the cell and molecule barcodes from the read names back to `XC`/`XM` tags,
+    writing a sorted and indexed BAM file.
+    """
+    unsorted_bam = output_bam + ".unsorted.bam"
+    with pysam.AlignmentFile(input_bam) as bam, pysam.AlignmentFile(unsorted_bam, "wb", template=bam) as output:
+        for aln in bam:
+            name, cell, molecule = aln.query_name.rsplit("|", 2)
+            aln.query_name = name
+            aln.set_tag("XC", cell)
+            aln.set_tag("XM", molecule)
+            output.write(aln)
+    pysam.sort("-o", output_bam, unsorted_bam)
+    pysam.index(output_bam)
+    os.remove(unsorted_bam)
+
+
+def align_command(fastq, index_dir, output_prefix, threads=4):
+    cmd = star
+    cmd += " --runThreadN {}".format(threads)
+    cmd += " --genomeDir {}".format(index_dir)
+    cmd += " --readFilesIn {}".format(fastq)
+    cmd += " --readFilesCommand zcat"
+    cmd += " --outSAMtype BAM Unsorted"
+    # MD tags are needed for the reference sequence of reads in gRNA assignment
+    cmd += " --outSAMattributes NH HI AS nM MD"
+    cmd += " --outFileNamePrefix {}".format(output_prefix)
+    return cmd
+
+
+def construct_bam(sample_root):
+    return os.path.join(sample_root, "gRNA_assignment", "construct_reads.bam")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--k", type=int, default=16, help="Length of k-mers shared with the constructs.")
+    parser.add_argument("--threads", type=int, default=4, help="Threads of each alignment.")
+    parser.add_argument("--samples", nargs="+", default=None, help="Names of samples to process (default all).")
+    args = parser.parse_args()
+    if args.k > 32:
+        parser.error("k-mers are encoded in 64 bits, use --k of at most 32.")
+
+    prj = Project(os.path.join("metadata", "config.yaml"))
+    output_dir = os.path.join(prj.output_dir, "spiked_genomes")
+    kmers = construct_kmers(prj, args.k)
+
+    jobs = list()
+    for sample in [s for s in prj.samples if hasattr(s, "replicate")]:
+        if args.samples is not None and sample.name not in args.samples:
+            continue
+        sample_dir = os.path.join(sample.paths.sample_root, "gRNA_assignment")
+        if not os.path.exists(sample_dir):
+            os.makedirs(sample_dir)
+        fastq = os.path.join(sample_dir, "construct_reads.fastq.gz")
+        prefix = os.path.join(sample_dir, "construct_reads.")
+
+        jobs.append(Job(sample.name, [
+            ("filter", partial(
+                filter_construct_reads,
+                os.path.join(sample.paths.sample_root, "star_gene_exon_tagged.clean.bam"), fastq, kmers, args.k)),
+            ("align", align_command(fastq, construct_dir(output_dir, sample.grna_library), prefix, args.threads)),
+            ("restore_tags", partial(restore_tags, prefix + "Aligned.out.bam", construct_bam(sample.paths.sample_root)))],
+            cpus=args.threads, mem=4000))
+
+    Executor(LocalBackend()).run(jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Principal component analysis computing only the requested number of components.
+
+Components are found with a randomized truncated SVD (Halko et al.), centering
+the data implicitly so that scipy.sparse matrices are never densified, or with
+an incremental PCA over chunks of samples for data that does not fit in memory.
+A fit keeps the scores of the samples it was fitted on, so there is no need to
+transform them again.
+"""
+
+import numpy as np
+import scipy.sparse
+
+from memoize import memoize
+
+
+class PCAFit(object):
+    """
+    Principal components of a samples x features matrix.
+
+    :param components: components x features np.array.
+    :param explained_variance: variance of the samples along each component.
+    :param total_variance: sum of the variances of all features.
+    :param mean: mean of each feature.
+    :param scores: samples x components np.array of the fitted samples (None for incremental fits).
+    """
+    def __init__(self, components, explained_variance, total_variance, mean, scores=None):
+        self.components_ = components
+        self.explained_variance_ = explained_variance
+        self.explained_variance_ratio_ = explained_variance / total_variance
+        self.mean_ = mean
+        self.scores = scores
+
+    def transform(self, x):
+        """
+        Scores of samples (np.array or scipy.sparse) on the components.
+        """
+        return x.dot(self.components_.T) - self.mean_.dot(self.components_.T)
+
+
+def _flip_signs(u, vt):
+    # make the largest loading of each component positive, for deterministic signs
+    signs = np.sign(u[np.abs(u).argmax(axis=0), np.arange(u.shape[1])])
+    signs[signs == 0] = 1
+    return u * signs, vt * signs[:, np.newaxis]
+
+
+def randomized_pca(x, n_components=2, n_oversamples=10, n_iter=4, random_state=0):
+    """
+    PCA by randomized truncated SVD of the implicitly centered matrix.
+
+    :param x: samples x features np.array or scipy.sparse matrix.
+    :returns: `PCAFit`.
+    """
+    n_samples = x.shape[0]
+    mean = np.asarray(x.mean(axis=0), dtype=np.float64).ravel()
+    if scipy.sparse.issparse(x):
+        squares = np.asarray(x.multiply(x).mean(axis=0)).ravel()
+    else:
+        squares = (np.asarray(x, dtype=np.float64) ** 2).mean(axis=0)
+    total_variance = ((squares - mean ** 2) * n_samples / (n_samples - 1.)).sum()
+
+    # products with the centered matrix, x - mean
+    def dot(b):
+        return x.dot(b) - mean.dot(b)[np.newaxis, :]
+
+    def rdot(b):
+        return x.T.dot(b) - np.outer(mean, b.sum(axis=0))
+
+    random_state = np.random.RandomState(random_state)
+    n_random = min(n_components + n_oversamples, min(x.shape))
+    q = dot(random_state.normal(size=(x.shape[1], n_random)))
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(q)
+        q = dot(rdot(q))
+    q, _ = np.linalg.qr(q)
+
+    u, s, vt = np.linalg.svd(rdot(q).T, full_matrices=False)
+    u, vt = _flip_signs(q.dot(u)[:, :n_components], vt[:n_components])
+    s = s[:n_components]
+    # projection of the samples on the components, as with `PCAFit.transform`
+    return PCAFit(vt, s ** 2 / (n_samples - 1.), total_variance, mean, scores=dot(vt.T))
+
+
+def incremental_pca(chunks, n_components=2):
+    """
+    PCA fitted one chunk of samples at a time.
+
+    :param chunks: iterable of samples x features np.arrays or scipy.sparse matrices (densified one at a time),
+                   each with at least `n_components` samples.
+    :returns: `PCAFit` without scores (see `PCAFit.transform`).
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    model = IncrementalPCA(n_components=n_components)
+    n_samples, sums, squares = 0, 0, 0
+    for chunk in chunks:
+        if scipy.sparse.issparse(chunk):
+            chunk = chunk.toarray()
+        chunk = np.asarray(chunk, dtype=np.float64)
+        model.partial_fit(chunk)
+        n_samples += chunk.shape[0]
+        sums = sums + chunk.sum(axis=0)
+        squares = squares + (chunk ** 2).sum(axis=0)
+    mean = sums / n_samples
+    total_variance = ((squares / n_samples - mean ** 2) * n_samples / (n_samples - 1.)).sum()
+    return PCAFit(model.components_, model.explained_variance_, total_variance, model.mean_)
+
+
+@memoize
+def fit_pca(x, n_components=2, chunk_size=None, random_state=0):
+    """
+    Top `n_components` principal components of the samples (rows) of `x`.
+
+    :param x: samples x features np.array, pd.DataFrame or scipy.sparse matrix.
+    :param chunk_size: fit incrementally on `chunk_size` samples at a time if given.
+    :returns: `PCAFit`, with the scores of the samples of `x`.
+    """
+    if not scipy.sparse.issparse(x):
+        x = np.asarray(x, dtype=np.float64)
+    n_components = min(n_components, min(x.shape))
+    if chunk_size is None:
+        return randomized_pca(x, n_components, random_state=random_state)
+
+    fit = incremental_pca((x[start:start + chunk_size] for start in range(0, x.shape[0], chunk_size)), n_components)
+    fit.scores = np.vstack([fit.transform(x[start:start + chunk_size]) for start in range(0, x.shape[0], chunk_size)])
+    return fit
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+Digital expression of Drop-seq samples straight from the gene-tagged alignments.
+
+`star_gene_exon_tagged.clean.bam` is streamed once, in parallel over references,
+and unique (cell `XC`, gene `GE`, UMI `XM`) molecules are counted with integer-encoded
+keys. From the molecules, the cell x gene count matrix, the `cell_umi_barcodes` table
+and the per-cell summary are produced together, in the formats written by the Drop-seq tools.
+
+As in Drop-seq's DigitalExpression (EDIT_DISTANCE=1), UMIs of the same cell and gene within
+one mismatch of a UMI with more reads are collapsed into it. Reads with N in their UMI are ignored.
+"""
+
+from looper.models import Project
+import argparse
+import os
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import pysam
+import scipy.io
+import scipy.sparse
+
+from cell_calling import call_cells, write_whitelist
+from expression_store import gene_thresholds
+
+
+# bits used for the codes of a molecule key: cell << 36 | gene << 16 | umi, within an int64
+cell_bits, gene_bits, umi_bits = 27, 20, 16
+
+
+def collapse_umis(umis, reads, max_distance=1):
+    """
+    Merge the UMIs of one cell and gene into UMIs with more reads within `max_distance` mismatches:
+    UMIs are visited by decreasing number of reads, each absorbing the remaining UMIs close to it.
+
+    :param umis: np.array of UMI sequences.
+    :param reads: np.array of the number of reads of each UMI.
+    :returns: np.array of the position of the UMI each UMI is merged into (itself if kept).
+    """
+    # mismatches between all pairs of UMIs, a difference of length counting as mismatches
+    bases = np.array(umis, dtype=bytes)
+    bases = bases.view(np.uint8).reshape(len(bases), -1)
+    close = (bases[:, np.newaxis, :] != bases[np.newaxis, :, :]).sum(axis=2) <= max_distance
+
+    target = np.arange(len(umis))
+    merged = np.zeros(len(umis), dtype=bool)
+    for i in np.argsort(-reads, kind="mergesort"):
+        if merged[i]:
+            continue
+        absorbed = close[i] & ~merged
+        target[absorbed] = i
+        merged |= absorbed
+    return target
+
+
+def count_region(args):
+    """
+    Count the reads of each unique (cell, gene, UMI) molecule in one region of a BAM file.
+
+    :param args: tuple of (BAM file, reference, minimum mapping quality, maximum UMI edit distance).
+    :returns: cell, gene and UMI barcodes and number of reads of each molecule.
+    """
+    bam_file, reference, min_mapq, umi_edit_distance = args
+
+    cells, genes, umis = dict(), dict(), dict()
+    molecules = dict()
+    with pysam.AlignmentFile(bam_file) as bam:
+        for aln in bam.fetch(reference=reference):
+            if aln.is_secondary or aln.is_supplementary or aln.is_qcfail or aln.mapping_quality < min_mapq:
+                continue
+            if not (aln.has_tag("XC") and aln.has_tag("GE") and aln.has_tag("XM")):
+                continue
+            gene = aln.get_tag("GE")
+            # reads on overlapping genes are ambiguous
+            if "," in gene:
+                continue
+            umi = aln.get_tag("XM")
+            if "N" in umi:
+                continue
+            cell = cells.setdefault(aln.get_tag("XC"), len(cells))
+            gene = genes.setdefault(gene, len(genes))
+            umi = umis.setdefault(umi, len(umis))
+            key = (cell << (gene_bits + umi_bits)) | (gene << umi_bits) | umi
+            molecules[key] = molecules.get(key, 0) + 1
+
+    for name, barcodes, bits in [("cell", cells, cell_bits), ("gene", genes, gene_bits), ("UMI", umis, umi_bits)]:
+        if len(barcodes) > 1 << bits:
+            raise ValueError(
+                "{} distinct {} barcodes in reference {} of {}, more than the {} that fit in a molecule key.".format(
+                    len(barcodes), name, reference, bam_file, 1 << bits))
+
+    keys = np.fromiter(molecules.keys(), dtype=np.int64, count=len(molecules))
+    reads = np.fromiter(molecules.values(), dtype=np.int64, count=len(molecules))
+    umi_mask = (1 << umi_bits) - 1
+    gene_mask = (1 << gene_bits) - 1
+
+    def decode(codes, barcodes):
+        names = np.empty(len(barcodes), dtype=object)
+        names[list(barcodes.values())] = list(barcodes.keys())
+        return names[codes]
+
+    if umi_edit_distance > 0 and len(keys) > 0:
+        # molecules of the same cell and gene are contiguous once sorted by key
+        order = np.argsort(keys)
+        keys, reads = keys[order], reads[order]
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(keys >> umi_bits)) + 1, [len(keys)]])
+        keep = np.ones(len(keys), dtype=bool)
+        umi_names = decode(np.arange(len(umis)), umis)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end - start < 2:
+                continue
+            target = collapse_umis(umi_names[keys[start:end] & umi_mask], reads[start:end], umi_edit_distance)
+            reads[start:end] = np.bincount(target, weights=reads[start:end], minlength=end - start)
+            keep[start:end] = target == np.arange(end - start)
+        keys, reads = keys[keep], reads[keep]
+
+    return (
+        decode(keys >> (gene_bits + umi_bits), cells),
+        decode((keys >> umi_bits) & gene_mask, genes),
+        decode(keys & umi_mask, umis),
+        reads)
+
+
+def count_molecules(bam_file, processes=8, min_mapq=10, umi_edit_distance=1):
+    """
+    Count the reads of each unique (cell, gene, UMI) molecule in a gene-tagged BAM file.
+    References are processed in parallel.
+
+    :param umi_edit_distance: UMIs of a cell and gene within this number of mismatches are
+                              collapsed (see `collapse_umis`), 0 to keep all UMIs.
+    :returns: pd.DataFrame with "cell", "gene", "umi" and "reads" columns.
+    """
+    with pysam.AlignmentFile(bam_file) as bam:
+        references = list(bam.references)
+    if len(references) == 0:
+        print("No references in {}.".format(bam_file))
+        return pd.DataFrame(columns=["cell", "gene", "umi", "reads"])
+
+    pool = Pool(processes)
+    regions = pool.map(count_region, [(bam_file, reference, min_mapq, umi_edit_distance) for reference in references])
+    pool.close()
+    pool.join()
+
+    return pd.DataFrame({
+        "cell": np.concatenate([r[0] for r in regions]),
+        "gene": np.concatenate([r[1] for r in regions]),
+        "umi": np.concatenate([r[2] for r in regions]),
+        "reads": np.concatenate([r[3] for r in regions]).astype(np.int64)},
+        columns=["cell", "gene", "umi", "reads"])
+
+
+def digital_expression(molecules, min_genes=None, cells=None):
+    """
+    Cell x gene UMI count matrix of the cells with at least `min_genes` genes detected
+    (or of the given `cells`), with a per-cell summary.
+
+    :returns: tuple of (scipy.sparse.csr_matrix, cell barcodes, gene names, summary pd.DataFrame).
+    """
+    cell_codes, cell_names = pd.factorize(molecules["cell"])
+    gene_codes, gene_names = pd.factorize(molecules["gene"], sort=True)
+    n_cells, n_genes = len(cell_names), len(gene_names)
+
+    matrix = scipy.sparse.coo_matrix(
+        (np.ones(len(cell_codes), dtype=np.int32), (cell_codes, gene_codes)),
+        shape=(n_cells, n_genes)).tocsr()
+
+    summary = pd.DataFrame({
+        "CELL_BARCODE": cell_names,
+        "NUM_GENIC_READS": np.bincount(cell_codes, weights=molecules["reads"].values, minlength=n_cells).astype(np.int64),
+        "NUM_TRANSCRIPTS": np.asarray(matrix.sum(axis=1)).ravel(),
+        "NUM_GENES": np.diff(matrix.indptr)},
+        columns=["CELL_BARCODE", "NUM_GENIC_READS", "NUM_TRANSCRIPTS", "NUM_GENES"])
+
+    if cells is not None:
+        keep = pd.Index(cell_names).isin(cells)
+    else:
+        keep = (summary["NUM_GENES"] >= (min_genes or 0)).values
+    # cells ordered by number of transcripts, as in the Drop-seq tools
+    order = np.flatnonzero(keep)[np.argsort(-summary["NUM_TRANSCRIPTS"].values[keep], kind="mergesort")]
+
+    return matrix[order], cell_names[order], gene_names, summary.iloc[order].reset_index(drop=True)
+
+
+def write_digital_expression(molecules, output_dir, n_genes=None, cells=None, suffix=None):
+    """
+    Write the digital expression of a sample in the formats of the Drop-seq tools:
+    `digital_expression.{suffix}.tsv` (genes x cells), `digital_expression.summary.{suffix}.tsv`
+    and `cell_umi_barcodes.{suffix}.tsv`, plus the sparse matrix in Matrix Market format.
+    """
+    if suffix is None:
+        suffix = "{}genes".format(n_genes)
+    matrix, cell_names, gene_names, summary = digital_expression(molecules, min_genes=n_genes, cells=cells)
+
+    # sparse cells x genes matrix
+    scipy.io.mmwrite(os.path.join(output_dir, "digital_expression.{}.mtx".format(suffix)), matrix)
+    pd.Series(cell_names).to_csv(os.path.join(output_dir, "digital_expression.{}.cells.txt".format(suffix)), index=False, header=False)
+    pd.Series(gene_names).to_csv(os.path.join(output_dir, "digital_expression.{}.genes.txt".format(suffix)), index=False, header=False)
+
+    # genes x cells table of detected genes
+    detected = np.asarray((matrix > 0).sum(axis=0)).ravel() > 0
+    exp = pd.DataFrame(matrix[:, detected].T.toarray(), index=pd.Index(gene_names[detected], name="GENE"), columns=cell_names)
+    exp.to_csv(os.path.join(output_dir, "digital_expression.{}.tsv".format(suffix)), sep="\t")
+
+    # with the two header lines of the Drop-seq metrics files
+    with open(os.path.join(output_dir, "digital_expression.summary.{}.tsv".format(suffix)), "w") as handle:
+        handle.write("## METRICS CLASS\torg.broadinstitute.dropseqrna.barnyard.DigitalExpression$DESummary\n\n")
+        summary.to_csv(handle, sep="\t", index=False)
+
+    umi = molecules[molecules["cell"].isin(cell_names)]
+    umi.columns = ["Cell Barcode", "Gene", "Molecular_Barcode", "Num_Obs"]
+    umi.to_csv(os.path.join(output_dir, "cell_umi_barcodes.{}.tsv".format(suffix)), sep="\t", index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=8, help="Number of references processed in parallel.")
+    parser.add_argument("--samples", nargs="+", default=None, help="Names of samples to process (default all).")
+    parser.add_argument(
+        "--umi-edit-distance", type=int, default=1,
+        help="Collapse UMIs of a cell and gene within this number of mismatches, as DigitalExpression (0 to keep all).")
+    parser.add_argument(
+        "--call-cells", action="store_true",
+        help="Also call cells from the UMIs of each barcode and write their whitelist and expression.")
+    args = parser.parse_args()
+
+    prj = Project(os.path.join("metadata", "config.yaml"))
+
+    for sample in [s for s in prj.samples if hasattr(s, "replicate")]:
+        if args.samples is not None and sample.name not in args.samples:
+            continue
+        print(sample.name)
+        bam = os.path.join(sample.paths.sample_root, "star_gene_exon_tagged.clean.bam")
+        molecules = count_molecules(bam, processes=args.processes, umi_edit_distance=args.umi_edit_distance)
+        for n_genes in gene_thresholds:
+            write_digital_expression(molecules, sample.paths.sample_root, n_genes=n_genes)
+
+        if args.call_cells:
+            matrix, barcodes, _, summary = digital_expression(molecules)
+            cells = call_cells(pd.Series(summary["NUM_TRANSCRIPTS"].values, index=barcodes), matrix)
+            print("{} cells called".format(len(cells)))
+            write_whitelist(cells, sample.paths.sample_root)
+            write_digital_expression(molecules, sample.paths.sample_root, cells=cells, suffix="called_cells")
+
+
+if __name__ == "__main__":
+    main()
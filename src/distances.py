@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Pairwise distances between samples (e.g. gRNA profiles) of the same condition, computed
+in blocks with matrix multiplications in float32 and split into distances between samples
+of the same group (e.g. targeting the same gene) or of different groups.
+"""
+
+import numpy as np
+import pandas as pd
+
+from memoize import memoize
+
+
+def _prepare(matrix, metric, dtype):
+    matrix = np.asarray(matrix, dtype=dtype)
+    if metric == "euclidean":
+        return matrix, (matrix.astype(np.float64) ** 2).sum(axis=1).astype(dtype)
+    if metric == "correlation":
+        # correlation distance is one minus the dot product of centered, unit-norm profiles
+        centered = matrix - matrix.mean(axis=1, keepdims=True)
+        norms = np.sqrt((centered.astype(np.float64) ** 2).sum(axis=1)).astype(dtype)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return centered / norms[:, np.newaxis], None
+    raise ValueError("Unknown metric: {}".format(metric))
+
+
+def _block_distances(x, y, x_norms, y_norms, metric):
+    products = x.dot(y.T)
+    if metric == "euclidean":
+        return np.sqrt(np.maximum(x_norms[:, np.newaxis] + y_norms[np.newaxis, :] - 2 * products, 0))
+    return 1 - products
+
+
+@memoize
+def group_distances(matrix, conditions, groups, metric="euclidean", block_size=2048, dtype=np.float32):
+    """
+    Distances between all pairs of samples of the same condition, labeled as "intra" if both
+    samples are of the same group and "inter" otherwise.
+
+    Samples are sorted by condition so that only pairs within a condition are computed,
+    in blocks of `block_size` rows of the upper triangle. Conditions and groups are compared
+    as integer codes. Each pair is reported once, with the group of its first sample.
+    Pairs of identical samples (distance 0) are excluded.
+
+    :param matrix: samples x features np.array.
+    :param conditions: condition of each sample.
+    :param groups: group of each sample.
+    :returns: pd.DataFrame with "distances", "condition", "group" and "relation" of each pair.
+    """
+    condition_codes, condition_names = pd.factorize(np.asarray(conditions), sort=True)
+    group_codes, group_names = pd.factorize(np.asarray(groups), sort=True)
+    prepared, norms = _prepare(matrix, metric, dtype)
+    order = np.argsort(condition_codes, kind="mergesort")
+    bounds = np.searchsorted(condition_codes[order], np.arange(len(condition_names) + 1))
+
+    distances, conditions, groups, intra = list(), list(), list(), list()
+    for c in range(len(condition_names)):
+        samples = order[bounds[c]:bounds[c + 1]]
+        x = prepared[samples]
+        x_norms = None if norms is None else norms[samples]
+        codes = group_codes[samples]
+        for start in range(0, len(samples), block_size):
+            end = min(start + block_size, len(samples))
+            block = _block_distances(
+                x[start:end], x[start:], None if x_norms is None else x_norms[start:end],
+                None if x_norms is None else x_norms[start:], metric)
+            # upper triangle only
+            i, j = np.nonzero(np.triu(np.ones(block.shape, dtype=bool), k=1))
+            d = block[i, j]
+            i, j = i + start, j + start
+            kept = (d != 0) & ~np.isnan(d)
+            distances.append(d[kept])
+            conditions.append(np.repeat(c, kept.sum()))
+            groups.append(codes[i[kept]])
+            intra.append(codes[i[kept]] == codes[j[kept]])
+
+    if len(distances) == 0:
+        return pd.DataFrame(columns=["distances", "condition", "group", "relation"])
+    return pd.DataFrame({
+        "distances": np.concatenate(distances),
+        "condition": condition_names[np.concatenate(conditions)],
+        "group": group_names[np.concatenate(groups)],
+        "relation": np.where(np.concatenate(intra), "intra", "inter")},
+        columns=["distances", "condition", "group", "relation"])
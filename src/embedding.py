@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Low-dimensional embeddings of many cells.
+
+Cells are described by a fixed number of principal components of their most
+variable genes, computed with a randomized SVD, and all methods are fitted on
+those components concurrently in a process pool. The k-nearest neighbour graph
+of the cells in that space is built once and used as affinity for spectral embedding.
+Methods whose cost grows quadratically with cells (Isomap) are fitted on a
+subsample of cells, onto which the remaining cells are then projected.
+"""
+
+from multiprocessing import Pool
+import numpy as np
+
+from decomposition import fit_pca
+from memoize import memoize
+
+
+def highly_variable_genes(matrix, n_genes=2000, n_bins=20):
+    """
+    Genes with the highest dispersion (variance / mean) relative to genes of similar mean expression.
+
+    :param matrix: genes x cells np.array.
+    :returns: np.array of row indices of the `n_genes` most variable genes.
+    """
+    mean = matrix.mean(axis=1)
+    var = matrix.var(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dispersion = np.log(var / mean)
+    dispersion[~np.isfinite(dispersion)] = -np.inf
+
+    # z-score the dispersion of genes within bins of mean expression
+    bins = np.digitize(mean, np.linspace(mean.min(), mean.max(), n_bins + 1)[1:-1])
+    normalized = np.full(len(mean), -np.inf)
+    for b in np.unique(bins):
+        genes = np.where((bins == b) & np.isfinite(dispersion))[0]
+        if len(genes) == 0:
+            continue
+        std = dispersion[genes].std()
+        normalized[genes] = (dispersion[genes] - dispersion[genes].mean()) / (std if std > 0 else 1)
+    return np.argsort(-normalized, kind="mergesort")[:min(n_genes, len(mean))]
+
+
+def principal_components(matrix, n_components=50, random_state=0):
+    """
+    Top principal components of the cells with a randomized SVD (see `decomposition.randomized_pca`).
+
+    :param matrix: genes x cells np.array.
+    :returns: tuple of cells x components np.array and the fraction of variance explained by each component.
+    """
+    fit = fit_pca(np.asarray(matrix, dtype=np.float32).T, n_components, random_state=random_state)
+    return fit.scores, fit.explained_variance_ratio_
+
+
+def knn_graph(points, n_neighbors=15):
+    """
+    Symmetric k-nearest neighbour connectivity graph (scipy.sparse) of the rows of `points`.
+    """
+    from sklearn.neighbors import kneighbors_graph
+
+    graph = kneighbors_graph(points, n_neighbors, mode="connectivity", include_self=False)
+    return graph.maximum(graph.T)
+
+
+# methods `embed` can fit on many cells (MDS, quadratic in cells, is not one of them)
+scalable_methods = ("PCA", "TSNE", "LocallyLinearEmbedding", "SpectralEmbedding", "Isomap")
+
+# data shared with the worker processes of `embed`
+_embedding = dict()
+
+
+def _init_embedding(data):
+    _embedding.update(data)
+
+
+def _fit_embedding(method):
+    """
+    Embedding of the cells with one method.
+    """
+    from sklearn.manifold import TSNE, LocallyLinearEmbedding, SpectralEmbedding, Isomap
+
+    d = _embedding
+    pcs, random_state = d["pcs"], d["random_state"]
+    if method == "PCA":
+        fitted = pcs
+    elif method == "SpectralEmbedding":
+        fitted = SpectralEmbedding(affinity="precomputed", random_state=random_state).fit_transform(d["graph"])
+    elif method == "TSNE":
+        fitted = TSNE(random_state=random_state).fit_transform(pcs)
+    elif method == "LocallyLinearEmbedding":
+        fitted = LocallyLinearEmbedding(
+            n_neighbors=d["n_neighbors"], eigen_solver="arpack", random_state=random_state).fit_transform(pcs)
+    elif method == "Isomap":
+        sample = np.random.RandomState(random_state).permutation(pcs.shape[0])[:d["max_cells"]]
+        fitted = Isomap(n_neighbors=d["n_neighbors"]).fit(pcs[sample]).transform(pcs)
+    else:
+        raise ValueError("Unknown embedding method: {}".format(method))
+    return method, fitted
+
+
+@memoize
+def embed(
+        matrix, methods=("PCA", "TSNE", "LocallyLinearEmbedding", "SpectralEmbedding", "Isomap"),
+        n_genes=2000, n_components=50, n_neighbors=15, max_cells=5000, random_state=0, processes=None):
+    """
+    Embed cells with several methods, on the principal components of their most variable genes.
+
+    :param matrix: genes x cells np.array of normalized expression.
+    :param methods: methods to fit, from `scalable_methods`; other methods are skipped.
+    :param max_cells: number of cells Isomap is fitted on.
+    :returns: tuple of dict of cells x dimensions np.array by method (all components for PCA)
+              and fraction of variance explained by each principal component.
+    """
+    skipped = [m for m in methods if m not in scalable_methods]
+    if len(skipped) > 0:
+        print("Skipping embedding methods not supported on many cells: {}".format(", ".join(skipped)))
+    methods = [m for m in methods if m in scalable_methods]
+
+    genes = highly_variable_genes(matrix, n_genes)
+    pcs, variance_ratio = principal_components(matrix[genes], n_components, random_state)
+
+    data = {
+        "pcs": pcs, "n_neighbors": n_neighbors, "max_cells": max_cells, "random_state": random_state,
+        "graph": knn_graph(pcs, n_neighbors) if "SpectralEmbedding" in methods else None}
+    pool = Pool(processes, initializer=_init_embedding, initargs=(data,))
+    embeddings = dict(pool.map(_fit_embedding, methods))
+    pool.close()
+    pool.join()
+    return embeddings, variance_ratio
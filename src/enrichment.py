@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+Local gene set enrichment, without the Enrichr web service.
+
+Gene set libraries are read from GMT files (as downloaded from the Enrichr libraries page,
+one per library, named <library>.gmt) into one sparse genes x sets membership matrix.
+The overlap of a gene list with all sets of all libraries is a single sparse product,
+from which hypergeometric p-values, z-scores and combined scores are computed for all sets at once.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.stats import hypergeom
+
+
+# indexes of gene set libraries, by tuple of GMT files
+_gene_set_indexes = dict()
+
+
+def read_gmt(gmt_file):
+    """
+    Gene sets of a GMT file: one set per line with its name, description and genes separated by tabs.
+
+    :returns: list of (set name, list of genes).
+    """
+    gene_sets = list()
+    with open(gmt_file, "r") as handle:
+        for line in handle:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3:
+                continue
+            # Enrichr GMT files may append a weight to genes ("GENE,1.0")
+            genes = [g.split(",")[0].strip() for g in fields[2:]]
+            gene_sets.append((fields[0], sorted(set(g for g in genes if g != ""))))
+    return gene_sets
+
+
+def gmt_file(gmt_dir, library):
+    return os.path.join(gmt_dir, library + ".gmt")
+
+
+def gene_set_index(gmt_files):
+    """
+    Sparse genes x sets membership matrix of the gene sets of several GMT files (libraries).
+    Indexes are kept in memory once built.
+
+    :returns: dict with "genes" (pd.Index), "sets" and "libraries" (name and library of each set),
+              "membership" (scipy.sparse.csc_matrix of genes x sets) and "universe" (genes x libraries
+              membership of genes in any set of each library).
+    """
+    gmt_files = tuple(gmt_files)
+    if gmt_files in _gene_set_indexes:
+        return _gene_set_indexes[gmt_files]
+
+    sets, libraries, set_genes = list(), list(), list()
+    for i, path in enumerate(gmt_files):
+        gene_sets = read_gmt(path)
+        if len(gene_sets) == 0:
+            raise ValueError("No gene sets in {}, is it a GMT file?".format(path))
+        for name, genes in gene_sets:
+            sets.append(name)
+            libraries.append(i)
+            set_genes.append(genes)
+
+    genes = pd.Index(sorted(set(g for s in set_genes for g in s)))
+    rows = np.concatenate([genes.get_indexer(s) for s in set_genes]) if set_genes else np.empty(0, dtype=np.int64)
+    cols = np.repeat(np.arange(len(set_genes)), [len(s) for s in set_genes])
+    membership = scipy.sparse.csc_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(len(genes), len(sets)))
+    libraries = np.array(libraries, dtype=np.int64)
+    library_indicator = scipy.sparse.csr_matrix(
+        (np.ones(len(sets)), (np.arange(len(sets)), libraries)), shape=(len(sets), len(gmt_files)))
+    universe = (membership.dot(library_indicator) > 0).astype(np.float64).tocsc()
+
+    index = {
+        "genes": genes, "sets": np.array(sets, dtype=object), "libraries": libraries,
+        "library_names": [os.path.splitext(os.path.basename(p))[0] for p in gmt_files],
+        "membership": membership, "universe": universe}
+    _gene_set_indexes[gmt_files] = index
+    return index
+
+
+def _fdr_bh(p_values):
+    """
+    Benjamini-Hochberg adjusted p-values.
+    """
+    order = np.argsort(p_values)
+    ranked = p_values[order] * len(p_values) / np.arange(1, len(p_values) + 1)
+    adjusted = np.empty(len(p_values))
+    adjusted[order] = np.minimum(1, np.minimum.accumulate(ranked[::-1])[::-1])
+    return adjusted
+
+
+def enrich(gene_list, index):
+    """
+    Enrichment of a gene list in all gene sets of an index (see `gene_set_index`).
+
+    For each set, genes of the list outside its library are ignored and the background is
+    all genes of the library. The z-score is the deviation of the overlap from its
+    hypergeometric expectation in standard deviations and the combined score is
+    -log(p-value) * z-score, as in Enrichr.
+
+    :returns: pd.DataFrame with the columns of Enrichr results, for sets overlapping the list.
+    """
+    query = np.zeros(len(index["genes"]))
+    positions = index["genes"].get_indexer(pd.Index(pd.Series(gene_list).dropna().drop_duplicates()))
+    query[positions[positions >= 0]] = 1
+
+    membership = index["membership"]
+    libraries = index["libraries"]
+    overlap = membership.T.dot(query)  # k
+    set_sizes = np.asarray(membership.sum(axis=0)).ravel()  # K
+    library_sizes = np.asarray(index["universe"].sum(axis=0)).ravel()[libraries]  # N
+    list_sizes = index["universe"].T.dot(query)[libraries]  # n
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_values = hypergeom.sf(overlap - 1, library_sizes, set_sizes, list_sizes)
+        expected = list_sizes * set_sizes / library_sizes
+        variance = expected * (library_sizes - set_sizes) / library_sizes * (library_sizes - list_sizes) / (library_sizes - 1)
+        z_scores = (overlap - expected) / np.sqrt(variance)
+    z_scores[variance == 0] = 0  # sets of all genes of their library
+    combined = -np.log(p_values) * z_scores
+
+    hits = np.where(overlap > 0)[0]
+    # genes of the list in each set
+    overlapping = scipy.sparse.csc_matrix(membership.multiply(query[:, np.newaxis]))[:, hits]
+    overlapping.eliminate_zeros()
+    genes = [
+        ";".join(index["genes"][overlapping.indices[overlapping.indptr[i]:overlapping.indptr[i + 1]]])
+        for i in range(len(hits))]
+
+    results = pd.DataFrame({
+        "description": index["sets"][hits], "p_value": p_values[hits], "z_score": z_scores[hits],
+        "combined_score": combined[hits], "genes": genes,
+        "gene_set_library": np.array(index["library_names"], dtype=object)[libraries[hits]]})
+    results["adjusted_p_value"] = np.nan
+    results["rank"] = 0
+    for library, lib_results in results.groupby("gene_set_library"):
+        results.loc[lib_results.index, "adjusted_p_value"] = _fdr_bh(lib_results["p_value"].values)
+        results.loc[lib_results.index, "rank"] = lib_results["p_value"].rank(method="first").astype(int)
+    return results.sort_values(["gene_set_library", "rank"])[
+        ["rank", "description", "p_value", "z_score", "combined_score", "genes", "adjusted_p_value", "gene_set_library"]
+    ].reset_index(drop=True)
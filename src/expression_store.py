@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+Storage of merged digital expression matrices.
+
+Expression of each experiment is collected once, at the most permissive gene
+threshold extracted by the Drop-seq pipeline, as sparse (gene, cell, count)
+triplets together with the number of genes detected in each cell.
+Any higher gene threshold is then just a column mask at read time.
+
+Samples are added one at a time and recorded with a fingerprint of their input
+file, so that new samples can be appended to an existing store.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# values of `min_genes_per_cell` extracted by the Drop-seq pipeline (see metadata/pipeline_config.yaml)
+gene_thresholds = [500, 100]
+min_genes = min(gene_thresholds)
+
+# maximum string lengths of the appendable tables
+min_itemsize = {"gene": 64, "sample": 128, "condition": 64, "replicate": 16, "cell": 32, "grna": 64, "fingerprint": 64}
+
+
+def genes_per_cell(exp):
+    """
+    Number of genes detected (at least one count) in each cell of a genes x cells matrix.
+    """
+    return (exp > 0).sum(axis=0)
+
+
+def sample_expression_file(sample_root):
+    return os.path.join(sample_root, "digital_expression.{}genes.tsv".format(min_genes))
+
+
+def file_fingerprint(input_file):
+    """
+    Cheap fingerprint of a file (size and modification time).
+    """
+    stat = os.stat(input_file)
+    return "{}:{}".format(stat.st_size, int(stat.st_mtime))
+
+
+def read_sample_expression(sample_root, n_genes=None):
+    """
+    Read the digital expression matrix of a sample extracted at the most permissive
+    gene threshold and keep only cells with at least `n_genes` genes detected.
+    """
+    exp = pd.read_csv(sample_expression_file(sample_root), sep="\t").set_index("GENE")
+    if n_genes is not None and n_genes > min_genes:
+        exp = exp.loc[:, (genes_per_cell(exp) >= n_genes).values]
+    return exp
+
+
+def expression_store_file(experiment, results_dir="results"):
+    return os.path.join(results_dir, "{}.digital_expression.hdf5".format(experiment))
+
+
+def stored_samples(store_file):
+    """
+    Fingerprints of the input files of the samples in an expression store, by sample name.
+    """
+    if not os.path.exists(store_file):
+        return dict()
+    with pd.HDFStore(store_file, "r") as store:
+        if "/samples" not in store.keys():
+            return dict()
+        return store["samples"]["fingerprint"].to_dict()
+
+
+def append_sample_to_store(store_file, exp, cells, sample_name, fingerprint=""):
+    """
+    Add the cells of one sample to an experiment's expression store.
+
+    :param exp: genes x cells matrix of counts of the sample.
+    :param cells: dataframe with one row per column of `exp` and
+                  columns "sample", "condition", "replicate", "cell" and "grna".
+    :param fingerprint: fingerprint of the sample's input file (see `file_fingerprint`).
+    """
+    with pd.HDFStore(store_file, "a", complevel=9, complib="zlib") as store:
+        genes = store["genes"]["gene"] if "/genes" in store.keys() else pd.Series(name="gene", dtype=object)
+        # new cells are numbered after the highest code in use (codes of removed samples are not reused)
+        codes = store.select_column("cells", "index") if "/cells" in store.keys() else []
+        n_cells = int(codes.max()) + 1 if len(codes) > 0 else 0
+
+        # register genes not seen before
+        new_genes = exp.index[~exp.index.isin(genes.values)]
+        if len(new_genes) > 0:
+            new_genes = pd.DataFrame(
+                {"gene": new_genes.astype(str)},
+                index=pd.Index(np.arange(len(new_genes)) + len(genes), name="gene_code"))
+            store.append("genes", new_genes, format="table", min_itemsize={"gene": min_itemsize["gene"]})
+            genes = pd.concat([genes, new_genes["gene"]])
+
+        # cell metadata, with number of genes per cell precomputed
+        cells = cells[["sample", "condition", "replicate", "cell", "grna"]].copy()
+        cells.index = pd.Index(np.arange(exp.shape[1]) + n_cells, name="cell_code")
+        cells["genes_per_cell"] = genes_per_cell(exp).values.astype(np.int32)
+        # unassigned cells are stored with an empty gRNA
+        cells["grna"] = cells["grna"].fillna("").astype(str)
+        store.append(
+            "cells", cells, format="table", data_columns=["sample"],
+            min_itemsize={k: v for k, v in min_itemsize.items() if k in cells.columns})
+
+        # non-zero counts as (gene, cell, count) triplets
+        gene_codes = pd.Index(genes.values).get_indexer(exp.index)
+        gene_idx, cell_idx = np.nonzero(exp.values)
+        counts = pd.DataFrame({
+            "gene_code": gene_codes[gene_idx].astype(np.int32),
+            "cell_code": (cell_idx + n_cells).astype(np.int32),
+            "count": exp.values[gene_idx, cell_idx].astype(np.int32)},
+            columns=["gene_code", "cell_code", "count"])
+        store.append("counts", counts, format="table", data_columns=["cell_code"], index=False)
+
+        # record sample
+        samples = pd.DataFrame(
+            {"fingerprint": [fingerprint]},
+            index=pd.Index([sample_name], name="sample"))
+        store.append("samples", samples, format="table", min_itemsize={"index": min_itemsize["sample"], "fingerprint": min_itemsize["fingerprint"]})
+
+
+def remove_sample_from_store(store_file, sample_name):
+    """
+    Remove the cells and counts of one sample from an expression store.
+    """
+    with pd.HDFStore(store_file, "a", complevel=9, complib="zlib") as store:
+        codes = store.select("cells", where="sample == {!r}".format(sample_name), columns=["sample"]).index
+        if len(codes) > 0:
+            # cells of a sample have contiguous codes
+            store.remove("counts", where="cell_code >= {} & cell_code <= {}".format(codes.min(), codes.max()))
+            store.remove("cells", where="index >= {} & index <= {}".format(codes.min(), codes.max()))
+        if "/samples" in store.keys():
+            store.remove("samples", where="index == {!r}".format(sample_name))
+
+
+def update_store_assignments(store_file, assignments):
+    """
+    Update in place the gRNA assigned to the cells of samples in an expression store.
+
+    :param assignments: dict of sample name: pd.Series of gRNA assignment indexed by cell.
+    """
+    with pd.HDFStore(store_file, "a", complevel=9, complib="zlib") as store:
+        cells = store["cells"]
+        for sample_name, assignment in assignments.items():
+            mask = (cells["sample"] == sample_name).values
+            cells.loc[mask, "grna"] = assignment.reindex(cells.loc[mask, "cell"]).fillna("").astype(str).values
+        store.put(
+            "cells", cells, format="table", data_columns=["sample"],
+            min_itemsize={k: v for k, v in min_itemsize.items() if k in cells.columns})
+
+
+def _select_cells(cells, n_genes=None, only_assigned=False):
+    cells["grna"] = cells["grna"].replace("", np.nan)
+    keep = np.ones(cells.shape[0], dtype=bool)
+    if n_genes is not None:
+        keep &= (cells["genes_per_cell"] >= n_genes).values
+    if only_assigned:
+        keep &= cells["grna"].notnull().values
+    return cells[keep]
+
+
+def _dense_matrix(genes, cells, counts):
+    """
+    Genes x cells matrix of the counts of the given cells.
+    """
+    # position of each cell in the output matrix (-1 if not selected)
+    n_codes = max(cells.index.max(), counts["cell_code"].max() if counts.shape[0] > 0 else 0) + 1
+    position = np.empty(n_codes, dtype=np.int64)
+    position.fill(-1)
+    position[cells.index.values] = np.arange(cells.shape[0])
+    position = position[counts["cell_code"].values]
+    sel = position >= 0
+    matrix = np.zeros((genes.shape[0], cells.shape[0]), dtype=np.int32)
+    matrix[counts["gene_code"].values[sel], position[sel]] = counts["count"].values[sel]
+
+    return pd.DataFrame(
+        matrix, index=genes.values,
+        columns=pd.MultiIndex.from_arrays(
+            [cells["condition"], cells["replicate"], cells["cell"], cells["grna"]],
+            names=['condition', 'replicate', 'cell', 'grna']))
+
+
+def read_expression_store(store_file, n_genes=None, only_assigned=False):
+    """
+    Read an experiment's expression store as a genes x cells matrix with
+    ['condition', 'replicate', 'cell', 'grna'] columns.
+
+    :param n_genes: keep only cells with at least this many genes detected.
+    :param only_assigned: keep only cells with a gRNA assigned.
+    """
+    with pd.HDFStore(store_file, "r") as store:
+        genes = store["genes"]["gene"]
+        cells = store["cells"]
+        counts = store["counts"]
+    exp = _dense_matrix(genes, _select_cells(cells, n_genes, only_assigned), counts)
+
+    # drop genes not detected in the selected cells
+    return exp[(exp.values > 0).any(axis=1)].sort_index()
+
+
+def iter_expression_store(store_file, n_genes=None, only_assigned=False, chunk_size=5000):
+    """
+    Read an experiment's expression store `chunk_size` cells at a time,
+    as genes x cells matrices (see `read_expression_store`) on the same sorted genes.
+    """
+    with pd.HDFStore(store_file, "r") as store:
+        genes = store["genes"]["gene"].sort_values()
+        cells = _select_cells(store["cells"], n_genes, only_assigned)
+        # position of each gene code in sorted order
+        gene_order = np.empty(genes.index.max() + 1, dtype=np.int64)
+        gene_order[genes.index.values] = np.arange(genes.shape[0])
+
+        for start in range(0, cells.shape[0], chunk_size):
+            chunk = cells.iloc[start:start + chunk_size]
+            counts = store.select(
+                "counts", where="cell_code >= {} & cell_code <= {}".format(chunk.index.min(), chunk.index.max()))
+            counts["gene_code"] = gene_order[counts["gene_code"].values]
+            yield _dense_matrix(genes, chunk, counts)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Helpers to work with the genome annotation (GTF) used to build the spiked references.
+"""
+
+import gzip
+import io
+import os
+import re
+import numpy as np
+import pandas as pd
+
+
+# in-process cache of gene ID to gene name mappings, by cache file
+_gene_name_mappings = dict()
+
+
+def open_text(path):
+    """
+    Open a (possibly gzipped) text file for reading.
+    """
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"))
+    return io.open(path, "r")
+
+
+def parse_gtf_gene_names(gtf_file):
+    """
+    Get the gene name of each gene ID in a GTF file (from its "gene" records).
+    """
+    gene_id = re.compile(r'gene_id "([^"]+)"')
+    gene_name = re.compile(r'gene_name "([^"]+)"')
+
+    ids = list()
+    names = list()
+    with open_text(gtf_file) as handle:
+        for line in handle:
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t", 8)
+            if len(fields) < 9 or fields[2] != "gene":
+                continue
+            i = gene_id.search(fields[8])
+            n = gene_name.search(fields[8])
+            if i is None:
+                continue
+            ids.append(i.group(1))
+            names.append(n.group(1) if n is not None else i.group(1))
+    return pd.Series(names, index=pd.Index(ids, name="ensembl_gene_id"), name="gene_name")
+
+
+def gene_name_mapping(cache_file, gtf_file=None):
+    """
+    Mapping of Ensembl gene IDs (without version) to gene names.
+
+    Read from `cache_file` if it exists, otherwise built from `gtf_file` and saved to `cache_file`.
+    Mappings are kept in memory once loaded.
+    """
+    if cache_file in _gene_name_mappings:
+        return _gene_name_mappings[cache_file]
+
+    if os.path.exists(cache_file):
+        mapping = pd.read_csv(cache_file, index_col=0)["gene_name"]
+    elif gtf_file is not None and os.path.exists(gtf_file):
+        mapping = parse_gtf_gene_names(gtf_file)
+        mapping.index = mapping.index.str.split(".").str.get(0)
+        mapping = mapping[~mapping.index.duplicated()]
+        mapping.to_frame().to_csv(cache_file, index=True)
+    else:
+        raise IOError(
+            "Gene name mapping '{}' does not exist and no GTF file to build it from was given. "
+            "Build it with `make makeref`.".format(cache_file))
+
+    _gene_name_mappings[cache_file] = mapping
+    return mapping
+
+
+def map_gene_names(gene_ids, mapping):
+    """
+    Map Ensembl gene IDs (with or without version) to gene names in one vectorized lookup.
+    Returns the gene names and a boolean mask of the IDs found in the mapping.
+    """
+    gene_ids = pd.Index(gene_ids).str.split(".").str.get(0)
+    codes = pd.Index(mapping.index).get_indexer(gene_ids)
+    found = codes >= 0
+    return mapping.values[codes[found]], found
+
+
+def _write_refflat_gene(transcripts, refflat_handle, gene_ends):
+    """
+    Write the transcripts of one gene as refFlat records and record the gene's end on each chromosome.
+    """
+    for transcript in transcripts.values():
+        exons = sorted(transcript["exons"])
+        starts = [start for start, _ in exons]
+        ends = [end for _, end in exons]
+        tx_start, tx_end = min(starts), max(ends)
+        if transcript["cds"]:
+            cds_start = min(start for start, _ in transcript["cds"])
+            cds_end = max(end for _, end in transcript["cds"])
+        else:
+            cds_start = cds_end = tx_end
+        refflat_handle.write("\t".join([
+            transcript["gene_name"], transcript["transcript_name"], transcript["chrom"], transcript["strand"],
+            str(tx_start), str(tx_end), str(cds_start), str(cds_end), str(len(exons)),
+            ",".join(map(str, starts)) + ",", ",".join(map(str, ends)) + ","]) + "\n")
+
+        key = (transcript["gene_name"], transcript["chrom"])
+        gene_ends[key] = max(gene_ends.get(key, 0), tx_end)
+
+
+def gtf_to_refflat(gtf_file, refflat_file, index_file=None):
+    """
+    Convert a GTF annotation to refFlat, streaming it once.
+
+    Exons are grouped per transcript one gene at a time, which assumes records of a gene are
+    contiguous (as in Ensembl GTFs and the gRNA spikes appended to them).
+    Optionally, an index of the end of each gene on each chromosome is written to `index_file`
+    (see `write_gene_ends`).
+    """
+    attribute = re.compile(r'(gene_id|gene_name|transcript_id|transcript_name) "([^"]+)"')
+
+    gene_ends = dict()
+    current_gene = None
+    transcripts = dict()
+    with open_text(gtf_file) as handle, io.open(refflat_file, "w") as refflat_handle:
+        for line in handle:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t", 8)
+            if len(fields) < 9 or fields[2] not in ("exon", "CDS", "stop_codon"):
+                continue
+            attributes = dict(attribute.findall(fields[8]))
+            if "transcript_id" not in attributes:
+                continue
+
+            if attributes["gene_id"] != current_gene:
+                _write_refflat_gene(transcripts, refflat_handle, gene_ends)
+                current_gene = attributes["gene_id"]
+                transcripts = dict()
+
+            transcript = transcripts.get(attributes["transcript_id"])
+            if transcript is None:
+                transcript = transcripts[attributes["transcript_id"]] = {
+                    "gene_name": attributes.get("gene_name", attributes["gene_id"]),
+                    "transcript_name": attributes.get("transcript_name", attributes["transcript_id"]),
+                    "chrom": fields[0], "strand": fields[6], "exons": list(), "cds": list()}
+            # refFlat coordinates are 0-based, half-open
+            interval = (int(fields[3]) - 1, int(fields[4]))
+            transcript["exons" if fields[2] == "exon" else "cds"].append(interval)
+        _write_refflat_gene(transcripts, refflat_handle, gene_ends)
+
+    if index_file is not None:
+        write_gene_ends(gene_ends, index_file)
+
+
+def gene_end_keys(genes, chroms):
+    return np.array(["{}\t{}".format(g, c) for g, c in zip(genes, chroms)], dtype=np.bytes_)
+
+
+def write_gene_ends(gene_ends, index_file):
+    """
+    Write the end of each gene on each chromosome as a binary array sorted by gene and chromosome,
+    which can be memory-mapped with `read_gene_ends`.
+
+    :param gene_ends: dict of (gene name, chromosome): end position.
+    """
+    keys = gene_end_keys([g for g, _ in gene_ends.keys()], [c for _, c in gene_ends.keys()])
+    index = np.empty(len(keys), dtype=[("key", keys.dtype), ("end", np.int64)])
+    index["key"] = keys
+    index["end"] = list(gene_ends.values())
+    index.sort(order="key")
+    np.save(index_file, index)
+
+
+def read_gene_ends(index_file):
+    return np.load(index_file, mmap_mode="r")
+
+
+def distance_to_gene_end(index, genes, chroms, positions):
+    """
+    Distance of each position to the end of its gene on its chromosome (NaN if not in the index).
+    """
+    keys = gene_end_keys(genes, chroms)
+    i = np.searchsorted(index["key"], keys)
+    i[i == len(index)] = 0
+    found = index["key"][i] == keys
+    distance = np.empty(len(keys), dtype=np.float64)
+    distance.fill(np.nan)
+    distance[found] = index["end"][i[found]] - np.asarray(positions)[found]
+    return distance
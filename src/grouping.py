@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Aggregation of the cells (columns) of a genes x cells matrix by levels of its column pd.MultiIndex,
+e.g. mean expression of each gene per condition and targeted gene.
+
+Group codes of each set of levels are computed once, group means come from a product with a sparse
+cells x groups indicator matrix and group medians from contiguous segments of the cells sorted by group,
+without transposing the matrix. Results are cached by set of levels, statistic and subset of genes
+in the `GroupIndex`, which callers create for a matrix and keep only while using it unchanged.
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+class GroupIndex(object):
+    """
+    Groups of the columns of a genes x cells pd.DataFrame by levels of its columns.
+    """
+    def __init__(self, df):
+        self.df = df
+        self._groups = dict()
+        self._results = dict()
+
+    def groups(self, levels):
+        """
+        Group of each cell by the values of `levels`, as in `df.T.groupby(level=levels)`:
+        groups are sorted and cells with missing values belong to no group.
+
+        :returns: tuple of group code of each cell (-1 for no group) and pd.MultiIndex of groups.
+        """
+        levels = tuple(levels)
+        if levels not in self._groups:
+            keys = pd.MultiIndex.from_arrays([self.df.columns.get_level_values(level) for level in levels])
+            codes, groups = pd.factorize(keys, sort=True)
+            missing = np.zeros(len(codes), dtype=bool)
+            for level in levels:
+                missing |= pd.isnull(self.df.columns.get_level_values(level))
+            if missing.any():
+                # renumber the groups left without cells with missing values
+                kept = np.unique(codes[~missing])
+                codes = np.where(missing, -1, np.searchsorted(kept, codes))
+                groups = groups[kept]
+            groups = pd.MultiIndex.from_tuples(list(groups), names=list(levels))
+            self._groups[levels] = (codes, groups)
+        return self._groups[levels]
+
+    def _rows(self, genes):
+        if genes is None:
+            return slice(None), self.df.index
+        # genes not in the matrix are dropped, as with `df.ix[genes].dropna()`
+        rows = self.df.index.get_indexer(pd.Index(genes))
+        rows = rows[rows >= 0]
+        return rows, self.df.index[rows]
+
+    def mean(self, levels, genes=None):
+        """
+        Mean of each gene (or of `genes` only) in each group of cells.
+
+        :returns: genes x groups pd.DataFrame.
+        """
+        key = (tuple(levels), "mean", None if genes is None else tuple(genes))
+        if key not in self._results:
+            codes, groups = self.groups(levels)
+            rows, index = self._rows(genes)
+            cells = np.where(codes >= 0)[0]
+            indicator = scipy.sparse.csr_matrix(
+                (np.ones(len(cells)), (codes[cells], cells)), shape=(len(groups), len(codes)))
+            values = self.df.values[rows]
+            sums = indicator.dot(values.T).T
+            self._results[key] = pd.DataFrame(
+                sums / np.bincount(codes[cells], minlength=len(groups)), index=index, columns=groups)
+        return self._results[key]
+
+    def median(self, levels, genes=None):
+        """
+        Median of each gene (or of `genes` only) in each group of cells.
+
+        :returns: genes x groups pd.DataFrame.
+        """
+        key = (tuple(levels), "median", None if genes is None else tuple(genes))
+        if key not in self._results:
+            codes, groups = self.groups(levels)
+            rows, index = self._rows(genes)
+            order = np.argsort(codes, kind="mergesort")
+            order = order[codes[order] >= 0]
+            bounds = np.searchsorted(codes[order], np.arange(len(groups) + 1))
+            values = self.df.values[rows][:, order]
+            medians = np.empty((values.shape[0], len(groups)))
+            for i in range(len(groups)):
+                medians[:, i] = np.median(values[:, bounds[i]:bounds[i + 1]], axis=1)
+            self._results[key] = pd.DataFrame(medians, index=index, columns=groups)
+        return self._results[key]
+
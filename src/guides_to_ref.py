@@ -1,9 +1,20 @@
 #!/usr/bin/env python
 
 from looper.models import Project
+import argparse
+import gzip
+import multiprocessing
 import os
+import shutil
+import time
+from functools import partial
 import pandas as pd
 
+from build_cache import build_key, file_digest, is_built, read_manifest, record_build
+from construct_reads import construct_dir, star
+from genome_annotation import gene_name_mapping, gtf_to_refflat
+from job_executor import Executor, Job, LocalBackend, SlurmBackend, succeeded
+
 
 def write_annotation(df, config, output_fasta, output_gtf, cas9=True):
     # create fasta and gtf entries for each gRNA
@@ -47,6 +58,24 @@ def write_annotation(df, config, output_fasta, output_gtf, cas9=True):
         gtf_handle.writelines(gtf_entries)
 
 
+def write_spiked(base_file, spike_file, output_file, buffer_size=2 ** 24):
+    """
+    Write a (gzipped) base genome FASTA or GTF followed by the spike records
+    to `output_file`, decompressing the base file in chunks without intermediate copies.
+    """
+    opener = gzip.open if base_file.endswith(".gz") else open
+    with opener(base_file, "rb") as base_handle, open(output_file, "wb") as output_handle:
+        last = b"\n"
+        for chunk in iter(lambda: base_handle.read(buffer_size), b""):
+            output_handle.write(chunk)
+            last = chunk[-1:]
+        # make sure spike records start on a new line
+        if last != b"\n":
+            output_handle.write(b"\n")
+        with open(spike_file, "rb") as spike_handle:
+            shutil.copyfileobj(spike_handle, output_handle, buffer_size)
+
+
 fasta_header_template = ">{chrom}_chrom dna:chromosome chromosome:GRCh38:{chrom}_chrom:1:{length}:1 REF"
 
 gtf_template = """{chrom}_chrom\thavana\tgene\t1\t{length}\t.\t+\t.\tgene_id "{id}_gene"; gene_name "{id}_gene"; gene_source "ensembl_havana"; gene_biotype "lincRNA";
@@ -54,16 +83,89 @@ gtf_template = """{chrom}_chrom\thavana\tgene\t1\t{length}\t.\t+\t.\tgene_id "{i
 {chrom}_chrom\thavana\texon\t1\t{length}\t.\t+\t.\tgene_id "{id}_gene"; transcript_id "{id}_transcript"; exon_number "1"; gene_name "{id}_gene"; gene_source "ensembl_havana"; gene_biotype "lincRNA"; transcript_name "{id}_transcript"; transcript_source "havana"; exon_id "{id}_exon";
 """
 
+def construct_config(config):
+    """
+    Sequences of the CROP-seq constructs used to build the spiked references.
+    """
+    return {k: config['crop-seq'][k] for k in ["u6", "rest", "cas9", "nls", "flag", "p2a", "blast", "space", "virus_ltr"]}
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--backend", default="slurm", choices=["slurm", "local"], help="Where to run the build commands.")
+parser.add_argument("--partition", default="develop", help="Slurm partition of the build commands.")
+parser.add_argument("--max-cpus", type=int, default=multiprocessing.cpu_count(), help="CPUs used by concurrent builds.")
+parser.add_argument("--max-mem", type=int, default=80000, help="Memory (MB) used by concurrent builds.")
+parser.add_argument("--dry-run", action="store_true", help="Only print the build commands.")
+args = parser.parse_args()
+
+backend = SlurmBackend(args.partition) if args.backend == "slurm" else LocalBackend()
+executor = Executor(backend, max_cpus=args.max_cpus, max_mem=args.max_mem, dry_run=args.dry_run)
+
 # initialize project
 prj = Project(os.path.join("metadata", "config.yaml"))
 
 # read in guide annotation
 annotation = pd.read_csv(os.path.join("metadata", "guide_annotation.csv"))
 
+output_dir = os.path.join(prj.output_dir, "spiked_genomes")
+if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+
+# builds are keyed by the contents of everything they are made of and skipped if already done
+manifest_file = os.path.join(output_dir, "manifest.json")
+manifest = read_manifest(manifest_file)
+
+# Get fasta genome and gtf annotation (shared by all libraries)
+genome_fasta = os.path.join(output_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.fa.gz")
+genome_gtf = os.path.join(output_dir, "Homo_sapiens.GRCh38.77.gtf.gz")
+downloads = Job("download", [
+    (os.path.basename(path), "wget -O {} {}".format(path, url))
+    for url, path in [
+        ("ftp://ftp.ensembl.org/pub/release-77/fasta/homo_sapiens/dna/Homo_sapiens.GRCh38.dna.primary_assembly.fa.gz", genome_fasta),
+        ("ftp://ftp.ensembl.org/pub/release-77/gtf/homo_sapiens/Homo_sapiens.GRCh38.77.gtf.gz", genome_gtf)]
+    if not os.path.exists(path)])
+if len(downloads.steps) > 0:
+    Executor(LocalBackend(), dry_run=args.dry_run).run([downloads])
+
+if not args.dry_run:
+    # Map Ensembl gene IDs to gene names (used offline when collecting bulk RNA-seq data)
+    gene_name_mapping(os.path.join(output_dir, "Homo_sapiens.GRCh38.77.gene_names.csv"), gtf_file=genome_gtf)
+
+jobs = list()
+
+# Construct-only references of each library, to align gRNA reads without the genome (see construct_reads.py)
+for library in annotation['library'].drop_duplicates():
+    library_annotation = annotation[annotation['library'] == library]
+    mini_dir = construct_dir(output_dir, library)
+    if not os.path.exists(mini_dir):
+        os.makedirs(mini_dir)
+    mini_fasta = os.path.join(mini_dir, "gRNA_spikes.fa")
+    mini_gtf = os.path.join(mini_dir, "gRNA_spikes.gtf")
+
+    key = build_key(
+        library_annotation[["oligo_name", "sequence"]].sort_values("oligo_name").values.tolist(),
+        construct_config(prj))
+    if is_built(manifest, os.path.basename(mini_dir), key):
+        print("Reference {} is up to date, skipping.".format(mini_dir))
+        continue
+    write_annotation(library_annotation, prj, mini_fasta, mini_gtf)
+
+    # index of a few kb of sequence
+    cmd = star
+    cmd += " --runThreadN 1"
+    cmd += " --runMode genomeGenerate"
+    cmd += " --genomeDir {}".format(mini_dir)
+    cmd += " --genomeFastaFiles {}".format(mini_fasta)
+    cmd += " --sjdbGTFfile {}".format(mini_gtf)
+    cmd += " --sjdbOverhang 74"
+    cmd += " --genomeSAindexNbases 4"
+    job = Job(os.path.basename(mini_dir), [("star_index", cmd)], cpus=1, mem=2000)
+    job.key, job.artefacts = key, {"fasta": mini_fasta, "gtf": mini_gtf, "star_index": os.path.join(mini_dir, "SA")}
+    jobs.append(job)
+
 for genome in prj.genomes.__dict__.keys():
     if genome.startswith("_"):
         continue
-    output_dir = os.path.join(prj.output_dir, "spiked_genomes")
     for library in annotation['library'].drop_duplicates():
 
         library_annotation = annotation[annotation['library'] == library]
@@ -72,9 +174,8 @@ for genome in prj.genomes.__dict__.keys():
 
         spiked_dir = os.path.join(output_dir, genome_ref) + "_" + library
 
-        for _dir in [output_dir, spiked_dir]:
-            if not os.path.exists(_dir):
-                os.makedirs(_dir)
+        if not os.path.exists(spiked_dir):
+            os.makedirs(spiked_dir)
 
         output_fasta = os.path.join(spiked_dir, "gRNA_spikes.fa")
         output_gtf = os.path.join(spiked_dir, "gRNA_spikes.gtf")
@@ -84,51 +185,64 @@ for genome in prj.genomes.__dict__.keys():
 
         # Make STAR index and supporting files
         if genome_ref == "hg38_spiked":
-            # Get fasta genome
-            os.system(
-                "wget -O {} ftp://ftp.ensembl.org/pub/release-77/fasta/homo_sapiens/dna/Homo_sapiens.GRCh38.dna.primary_assembly.fa.gz"
-                .format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.fa.gz")))
-            os.system("gzip -d {}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.fa.gz")))
-            # Get gtf annotation
-            os.system(
-                "wget -O {} ftp://ftp.ensembl.org/pub/release-77/gtf/homo_sapiens/Homo_sapiens.GRCh38.77.gtf.gz"
-                .format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.77.gtf.gz")))
-            os.system("gzip -d {}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.77.gtf.gz")))
-
+            artefacts = {
+                "fasta": os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.fa"),
+                "gtf": os.path.join(spiked_dir, "Homo_sapiens.GRCh38.77.spiked.gtf"),
+                "star_index": os.path.join(spiked_dir, "SA"),
+                "dict": os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.dict"),
+                "refflat": os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.refFlat"),
+                "gene_ends": os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.gene_ends.npy")}
+
+            if os.path.exists(genome_fasta) and os.path.exists(genome_gtf):
+                key = build_key(
+                    file_digest(genome_fasta, manifest), file_digest(genome_gtf, manifest),
+                    library_annotation[["oligo_name", "sequence"]].sort_values("oligo_name").values.tolist(),
+                    construct_config(prj), genome)
+            else:
+                # only when the base genome has not been downloaded in a dry run
+                key = None
+            if key is not None and is_built(manifest, os.path.basename(spiked_dir), key):
+                print("Reference {} is up to date, skipping.".format(spiked_dir))
+                continue
+            print("Building reference {}.".format(spiked_dir))
+
+            steps = list()
             # Add extra chromosomes (CROP-seq constructs) to genome
-            os.system(
-                "cat {} {} > {}"
-                .format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.fa"), output_fasta, os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.fa")))
-            os.system(
-                "cat {} {} > {}"
-                .format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.77.gtf"), output_gtf, os.path.join(spiked_dir, "Homo_sapiens.GRCh38.77.spiked.gtf")))
+            steps.append(("spike_fasta", partial(write_spiked, genome_fasta, output_fasta, artefacts["fasta"])))
+            steps.append(("spike_gtf", partial(write_spiked, genome_gtf, output_gtf, artefacts["gtf"])))
 
             # Build STAR index (contruct + spiked with gRNAs)
-            cmd = "srun --mem 80000 -p develop /cm/shared/apps/star/2.4.2a/STAR"
+            cmd = star
             cmd += " --runThreadN 8"
             cmd += " --runMode genomeGenerate"
             cmd += " --genomeDir {}".format(spiked_dir)
-            cmd += " --genomeFastaFiles {}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.fa"))
-            cmd += " --sjdbGTFfile {}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.77.spiked.gtf"))
+            cmd += " --genomeFastaFiles {}".format(artefacts["fasta"])
+            cmd += " --sjdbGTFfile {}".format(artefacts["gtf"])
             cmd += " --sjdbOverhang 74"
-            os.system(cmd)
+            steps.append(("star_index", cmd))
 
             # Create sequence dictionaries (for piccard)
-            cmd = "srun --mem 80000 -p develop java -Xmx8g -jar /cm/shared/apps/picard-tools/1.140/picard.jar"
+            cmd = "java -Xmx8g -jar /cm/shared/apps/picard-tools/1.140/picard.jar"
             cmd += " CreateSequenceDictionary"
-            cmd += " REFERENCE={}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.fa"))
-            cmd += " OUTPUT={}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.dict"))
+            cmd += " REFERENCE={}".format(artefacts["fasta"])
+            cmd += " OUTPUT={}".format(artefacts["dict"])
             cmd += " GENOME_ASSEMBLY={}".format(genome)
             cmd += " SPECIES=human"
-            os.system(cmd)
-
-            # Create reflat files
-            cmd = "srun --mem 80000 -p develop java -Xmx80g -jar ~/Drop-seq_tools-1.12/jar/dropseq.jar ConvertToRefFlat"
-            cmd += " SEQUENCE_DICTIONARY={}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.dict"))
-            cmd += " ANNOTATIONS_FILE= {}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.77.spiked.gtf"))
-            cmd += " OUTPUT={}".format(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.refFlat"))
-            os.system(cmd)
-
-            # Remove vanilla genome
-            os.remove(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.dna.primary_assembly.fa"))
-            os.remove(os.path.join(spiked_dir, "Homo_sapiens.GRCh38.77.gtf"))
+            steps.append(("sequence_dictionary", cmd))
+
+            # Create reflat files (and index of gene ends used by qc_plots.py)
+            steps.append(("refflat", partial(gtf_to_refflat, artefacts["gtf"], artefacts["refflat"], artefacts["gene_ends"])))
+
+            job = Job(os.path.basename(spiked_dir), steps, cpus=8, mem=80000)
+            job.key, job.artefacts = key, artefacts
+            jobs.append(job)
+
+# Build references concurrently
+steps = executor.run(jobs)
+if not args.dry_run:
+    steps.to_csv(os.path.join(output_dir, "build_steps.{}.csv".format(time.strftime("%Y%m%d-%H%M%S"))), index=False)
+    for job in jobs:
+        if succeeded(job, steps) and job.key is not None:
+            record_build(manifest, manifest_file, job.name, job.key, job.artefacts, steps.loc[steps["job"] == job.name, "seconds"].sum())
+        else:
+            print("Building reference {} failed.".format(job.name))
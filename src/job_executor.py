@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Execution of external jobs (sequences of commands) with bounded concurrency.
+
+Jobs are independent and run concurrently as long as their CPUs and memory fit
+the limits of the executor. The steps of a job run one after the other and a job
+stops at its first failing step. Each step is run through a backend: locally
+(`LocalBackend`) or submitted to a cluster (`SlurmBackend`); other backends only
+need a `command(cmd, cpus, mem)` method returning the command to run.
+"""
+
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import pandas as pd
+
+
+class LocalBackend(object):
+    """
+    Run commands on the local machine.
+    """
+    def command(self, cmd, cpus, mem):
+        return cmd
+
+
+class SlurmBackend(object):
+    """
+    Run commands as slurm job steps with `srun`.
+    """
+    def __init__(self, partition="develop"):
+        self.partition = partition
+
+    def command(self, cmd, cpus, mem):
+        return "srun --mem {} -c {} -p {} {}".format(mem, cpus, self.partition, cmd)
+
+
+class Job(object):
+    """
+    A named sequence of steps, using at most `cpus` CPUs and `mem` MB of memory.
+
+    :param steps: list of (step name, command) where the command is a shell command
+                  (run through the backend) or a Python callable (run in-process).
+    """
+    def __init__(self, name, steps, cpus=1, mem=4000):
+        self.name = name
+        self.steps = steps
+        self.cpus = cpus
+        self.mem = mem
+
+
+class Executor(object):
+    """
+    Run jobs concurrently within CPU and memory limits.
+
+    :param max_cpus: total CPUs of concurrently running jobs.
+    :param max_mem: total memory (MB) of concurrently running jobs.
+    :param dry_run: only print the commands that would be run.
+    """
+    def __init__(self, backend=None, max_cpus=8, max_mem=80000, dry_run=False):
+        self.backend = backend if backend is not None else LocalBackend()
+        self.max_cpus = max_cpus
+        self.max_mem = max_mem
+        self.dry_run = dry_run
+        self._used_cpus = 0
+        self._used_mem = 0
+        self._resources = threading.Condition()
+
+    def _acquire(self, job):
+        # jobs larger than the limits run alone
+        cpus, mem = min(job.cpus, self.max_cpus), min(job.mem, self.max_mem)
+        with self._resources:
+            while self._used_cpus + cpus > self.max_cpus or self._used_mem + mem > self.max_mem:
+                self._resources.wait()
+            self._used_cpus += cpus
+            self._used_mem += mem
+        return cpus, mem
+
+    def _release(self, cpus, mem):
+        with self._resources:
+            self._used_cpus -= cpus
+            self._used_mem -= mem
+            self._resources.notify_all()
+
+    def run_step(self, job, step_name, cmd):
+        """
+        Run one step of a job, returning its exit status.
+        """
+        if callable(cmd):
+            print("[{}] {}: {}".format(job.name, step_name, getattr(cmd, "__name__", repr(cmd))))
+            if self.dry_run:
+                return 0
+            try:
+                cmd()
+                return 0
+            except Exception as e:
+                print("[{}] {} failed: {}".format(job.name, step_name, e))
+                return 1
+
+        cmd = self.backend.command(cmd, job.cpus, job.mem)
+        print("[{}] {}: {}".format(job.name, step_name, cmd))
+        if self.dry_run:
+            return 0
+        return subprocess.call(cmd, shell=True)
+
+    def run_job(self, job):
+        """
+        Run the steps of a job in order until one fails.
+
+        :returns: list of dicts with job, step, exit status, start time and duration of each step run.
+        """
+        cpus, mem = self._acquire(job)
+        steps = list()
+        try:
+            for step_name, cmd in job.steps:
+                start = time.time()
+                status = self.run_step(job, step_name, cmd)
+                steps.append({
+                    "job": job.name, "step": step_name, "status": status,
+                    "start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start)),
+                    "seconds": round(time.time() - start, 1)})
+                if status != 0:
+                    print("[{}] Step {} exited with status {}, stopping job.".format(job.name, step_name, status))
+                    break
+        finally:
+            self._release(cpus, mem)
+        return steps
+
+    def run(self, jobs):
+        """
+        Run jobs concurrently.
+
+        :returns: pd.DataFrame with one row per step run (see `run_job`).
+        """
+        if len(jobs) == 0:
+            return pd.DataFrame(columns=["job", "step", "status", "start", "seconds"])
+        pool = ThreadPool(len(jobs))
+        steps = pool.map(self.run_job, jobs)
+        pool.close()
+        pool.join()
+        return pd.DataFrame(
+            [step for job_steps in steps for step in job_steps],
+            columns=["job", "step", "status", "start", "seconds"])
+
+
+def succeeded(job, steps):
+    """
+    Whether all steps of a job ran with exit status 0.
+    """
+    job_steps = steps[steps["job"] == job.name]
+    return bool(job_steps.shape[0] == len(job.steps) and (job_steps["status"] == 0).all())
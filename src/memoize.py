@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Disk cache of the results of expensive analysis steps.
+
+Functions decorated with `memoize` are keyed by a hash of their name and code, the source of
+their module and of the modules of the same directory it uses (so that edits of helper functions
+also invalidate results), the contents of their array arguments (values, index and columns of
+pandas objects, the arrays of scipy.sparse matrices) and their other parameters, defaults included. Results are pickled to the cache
+directory, which is kept under a maximum size by removing the least recently used
+results. Set the environment variable CROPSEQ_NO_CACHE=1 (or `settings["enabled"] = False`)
+to always recompute.
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import types
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+settings = {
+    "enabled": os.environ.get("CROPSEQ_NO_CACHE", "0") != "1",
+    "cache_dir": os.environ.get("CROPSEQ_CACHE_DIR", os.path.join("results", ".cache")),
+    "max_size": 20 * 2 ** 30}  # bytes
+
+# fingerprints of the source of modules and their dependencies, by module name
+_module_fingerprints = dict()
+
+
+def _update(digest, obj):
+    """
+    Add an object to a hash, by contents for arrays, pandas and scipy.sparse objects.
+    """
+    digest.update(type(obj).__name__.encode("utf-8"))
+    if isinstance(obj, np.ndarray):
+        digest.update(str((obj.dtype, obj.shape)).encode("utf-8"))
+        if obj.dtype == object:
+            digest.update(pickle.dumps(obj.tolist(), protocol=2))
+        else:
+            digest.update(np.ascontiguousarray(obj).view(np.uint8))
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        _update(digest, obj.values)
+        _update(digest, obj.index)
+        if isinstance(obj, pd.DataFrame):
+            _update(digest, obj.columns)
+    elif isinstance(obj, pd.Index):
+        digest.update(str(list(obj.names)).encode("utf-8"))
+        # values of MultiIndexes are tuples, hashed as an object array
+        _update(digest, np.asarray(obj.values))
+    elif scipy.sparse.issparse(obj):
+        obj = obj.tocsr()
+        digest.update(str(obj.shape).encode("utf-8"))
+        for array in [obj.data, obj.indices, obj.indptr]:
+            _update(digest, array)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _update(digest, item)
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            _update(digest, key)
+            _update(digest, obj[key])
+    else:
+        digest.update(repr(obj).encode("utf-8"))
+    digest.update(b"\0")
+
+
+def fingerprint(*objects):
+    """
+    Hash of the contents of objects.
+    """
+    digest = hashlib.sha1()
+    for obj in objects:
+        _update(digest, obj)
+    return digest.hexdigest()
+
+
+def code_fingerprint(code):
+    """
+    Hash of the bytecode and constants of a code object (including those of nested functions),
+    so that results are not reused once a function is edited.
+    """
+    digest = hashlib.sha1(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            digest.update(code_fingerprint(const).encode("utf-8"))
+        else:
+            digest.update(repr(const).encode("utf-8"))
+    digest.update(repr(code.co_names).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _module_files(module, files):
+    """
+    Source files of a module and, recursively, of the modules of the same directory it uses.
+    """
+    path = getattr(module, "__file__", None)
+    if path is None:
+        return files
+    path = os.path.abspath(path)
+    if path.endswith((".pyc", ".pyo")):
+        path = path[:-1]
+    if path in files or not os.path.exists(path):
+        return files
+    files.add(path)
+    for value in list(vars(module).values()):
+        if isinstance(value, types.ModuleType):
+            dependency = value
+        else:
+            name = getattr(value, "__module__", None)
+            dependency = sys.modules.get(name) if isinstance(name, str) else None
+        dependency_path = getattr(dependency, "__file__", None)
+        if dependency_path is not None and os.path.dirname(os.path.abspath(dependency_path)) == os.path.dirname(path):
+            _module_files(dependency, files)
+    return files
+
+
+def module_fingerprint(name):
+    """
+    Hash of the source of a module and of the modules of the same directory it uses.
+    """
+    if name not in _module_fingerprints:
+        digest = hashlib.sha1()
+        for path in sorted(_module_files(sys.modules[name], set())):
+            with open(path, "rb") as handle:
+                digest.update(handle.read())
+        _module_fingerprints[name] = digest.hexdigest()
+    return _module_fingerprints[name]
+
+
+def _evict(cache_dir, max_size):
+    """
+    Remove the least recently used results until the cache fits in `max_size` bytes.
+    """
+    entries = list()
+    for name in os.listdir(cache_dir):
+        if name.endswith(".pickle"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    size = sum(e[1] for e in entries)
+    for _, entry_size, name in sorted(entries):
+        if size <= max_size:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        size -= entry_size
+
+
+def memoize(function):
+    """
+    Cache the results of a function on disk, by contents of its arguments.
+    """
+    code = code_fingerprint(function.__code__)
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not settings["enabled"]:
+            return function(*args, **kwargs)
+
+        cache_dir = settings["cache_dir"]
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        # the module is fully imported by the first call
+        key = fingerprint(
+            function.__module__, function.__name__, code, module_fingerprint(function.__module__),
+            dict(arguments.arguments))
+        cache_file = os.path.join(cache_dir, "{}.{}.pickle".format(function.__name__, key))
+        if os.path.exists(cache_file):
+            # mark as recently used
+            os.utime(cache_file, None)
+            with open(cache_file, "rb") as handle:
+                return pickle.load(handle)
+
+        result = function(*args, **kwargs)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # write atomically, so that interrupted runs leave no partial results
+        with open(cache_file + ".tmp", "wb") as handle:
+            pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(cache_file + ".tmp", cache_file)
+        _evict(cache_dir, settings["max_size"])
+        return result
+    return wrapper
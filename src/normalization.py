@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Normalization of genes x cells expression matrices.
+
+Cells are scaled by a size factor computed once per cell (e.g. their total counts)
+and log2-transformed, with NumPy broadcasting on dense matrices or on the non-zero
+values only of sparse matrices. Matrices can be processed in chunks of cells,
+including straight from an expression store to an HDF5 file for matrices larger than memory.
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from expression_store import iter_expression_store
+
+
+def total_counts(matrix):
+    """
+    Total counts of each cell (column).
+    """
+    return np.asarray(matrix.sum(axis=0), dtype=np.float64).ravel()
+
+
+# size factor of each cell by kind of normalization
+normalizations = {
+    "total": total_counts}
+
+
+def normalize_matrix(matrix, kind="total", scale=1e4, log=True, dtype=np.float32):
+    """
+    Normalize the cells (columns) of a matrix: log2(1 + x / size_factor * scale).
+
+    :param matrix: genes x cells np.ndarray or scipy.sparse matrix.
+    :param kind: normalization, a key of `normalizations`.
+    :returns: normalized matrix of `dtype`, sparse (CSC) if the input is sparse.
+    """
+    factors = scale / normalizations[kind](matrix)
+    factors[~np.isfinite(factors)] = 0
+
+    if scipy.sparse.issparse(matrix):
+        norm = scipy.sparse.csc_matrix(matrix, dtype=dtype, copy=True)
+        # scale the non-zero values by the factor of their column
+        norm.data *= np.repeat(factors, np.diff(norm.indptr)).astype(dtype)
+        values = norm.data
+    else:
+        norm = np.array(matrix, dtype=dtype)
+        norm *= factors.astype(dtype)
+        values = norm
+
+    if log:
+        np.log1p(values, out=values)
+        values /= dtype(np.log(2))
+    return norm
+
+
+def normalize_frame(df, chunk_size=None, **kwargs):
+    """
+    Normalize a genes x cells pd.DataFrame, `chunk_size` cells at a time if given
+    (see `normalize_matrix` for keyword arguments).
+    """
+    if chunk_size is None:
+        return pd.DataFrame(normalize_matrix(df.values, **kwargs), index=df.index, columns=df.columns)
+
+    norm = np.empty(df.shape, dtype=kwargs.get("dtype", np.float32))
+    for start in range(0, df.shape[1], chunk_size):
+        norm[:, start:start + chunk_size] = normalize_matrix(df.values[:, start:start + chunk_size], **kwargs)
+    return pd.DataFrame(norm, index=df.index, columns=df.columns)
+
+
+def normalize_store(store_file, output_file, n_genes=None, only_assigned=False, chunk_size=5000, **kwargs):
+    """
+    Normalize the expression in an expression store, `chunk_size` cells at a time,
+    writing a genes x cells "matrix" dataset and its "genes" and "cells" labels to an HDF5 file.
+    Neither the counts nor the normalized values of all cells need to fit in memory.
+    """
+    import h5py
+    dtype = kwargs.get("dtype", np.float32)
+    with h5py.File(output_file, "w") as handle:
+        matrix = cells = None
+        for chunk in iter_expression_store(store_file, n_genes=n_genes, only_assigned=only_assigned, chunk_size=chunk_size):
+            if matrix is None:
+                handle.create_dataset("genes", data=np.array(chunk.index, dtype=np.bytes_))
+                matrix = handle.create_dataset(
+                    "matrix", shape=(chunk.shape[0], 0), maxshape=(chunk.shape[0], None),
+                    dtype=dtype, chunks=(min(chunk.shape[0], 1024), min(chunk_size, 1024)), compression="gzip")
+                cells = handle.create_dataset(
+                    "cells", shape=(0, chunk.columns.nlevels), maxshape=(None, chunk.columns.nlevels),
+                    dtype=h5py.special_dtype(vlen=str))
+                cells.attrs["names"] = list(chunk.columns.names)
+            start = matrix.shape[1]
+            matrix.resize(start + chunk.shape[1], axis=1)
+            matrix[:, start:] = normalize_matrix(chunk.values, **kwargs)
+            cells.resize(start + chunk.shape[1], axis=0)
+            cells[start:] = np.array([[str(v) for v in c] for c in chunk.columns], dtype=object)
@@ -10,6 +10,9 @@ import seaborn as sns
 from collections import Counter
 from looper.models import Project
 
+from expression_store import min_genes, read_sample_expression
+from genome_annotation import distance_to_gene_end, read_gene_ends
+
 
 # Set settings
 pd.set_option("date_dayfirst", True)
@@ -64,20 +67,27 @@ for sample in [s for s in prj.samples if hasattr(s, "replicate")]:  # [s for s i
     except IOError:
         pass  # if error, it will automatically be pd.np.nan
 
+    # Gather additional metrics from transcriptome:
+    # read the matrix extracted at the most permissive threshold once,
+    # each gene threshold is then a mask on the cells
+    try:
+        sample_exp = read_sample_expression(sample.paths.sample_root)
+        sample_umi = pd.read_csv(
+            os.path.join(sample.paths.sample_root, "cell_umi_barcodes.{}genes.tsv".format(min_genes)),
+            sep="\t")
+    except IOError:
+        continue
+    sample_genes_per_cell = (sample_exp > 0).sum(axis=0)
+
     for n_genes in gene_thresholds:
-        # Gather additional metrics from transcriptome:
-        try:
-            exp = pd.read_csv(
-                os.path.join(sample.paths.sample_root, "digital_expression.{}genes.tsv".format(n_genes)),
-                sep="\t").set_index("GENE")
-        except IOError:
-            continue
+        exp = sample_exp.loc[:, (sample_genes_per_cell >= n_genes).values]
+
         # reads per cell
         reads_per_cell = exp.sum(axis=0)
         stats.loc[sample_mask, "{}genes_total_used_reads".format(n_genes)] = reads_per_cell.sum()
 
         # # genes per cell
-        genes_per_cell = exp.apply(lambda x: (x > 0).sum(), axis=0)
+        genes_per_cell = sample_genes_per_cell[exp.columns]
         # # % mitochondrial
         mito_per_cell = (exp.ix[exp.index[exp.index.str.contains("^MT-")]].sum(axis=0) / reads_per_cell) * 100
         # # % ribosomal proteins
@@ -89,9 +99,7 @@ for sample in [s for s in prj.samples if hasattr(s, "replicate")]:  # [s for s i
             stats.loc[sample_mask, "{}genes_median_{}".format(n_genes, metric)] = eval(metric).median()
 
         # UMI duplication stats
-        umi = pd.read_csv(
-            os.path.join(sample.paths.sample_root, "cell_umi_barcodes.{}genes.tsv".format(n_genes)),
-            sep="\t")
+        umi = sample_umi[sample_umi['Cell Barcode'].isin(exp.columns)]
 
         # get duplication per cell
         dups = umi.groupby(['Cell Barcode'])['Num_Obs'].apply(lambda x: (x == 1).sum())
@@ -163,18 +171,17 @@ for sample in [s for s in prj.samples if hasattr(s, "replicate")]:  # [s for s i
             bbox_inches="tight", dpi=300)
 
         # Number of genes assigned depending on the minimum number of genes required
+        # (cells above each threshold counted at once on the sorted values)
+        original_names = pd.Series(reads_per_cell.index.str.split("_")).apply(lambda x: x[0])
+        is_assigned = original_names.isin(sample_assignments.index.dropna()).values
         for metric in ["genes_per_cell", "reads_per_cell"]:
-            total = list()
-            assigned = list()
-            for j in range(1, 50000, 10):
-                pos = eval(metric) > j
-                d = eval(metric)[pos]
-                try:
-                    original_names = pd.Series(d.index.str.split("_")).apply(lambda x: x[0])
-                    assigned.append(original_names.isin(sample_assignments.index.dropna()).sum())
-                    total.append(pos.sum())
-                except AttributeError:
-                    break
+            values = eval(metric).values
+            thresholds = np.arange(1, 50000, 10)
+            thresholds = thresholds[thresholds < values.max()]
+            all_values = np.sort(values)
+            assigned_values = np.sort(values[is_assigned])
+            total = len(all_values) - np.searchsorted(all_values, thresholds, side="right")
+            assigned = len(assigned_values) - np.searchsorted(assigned_values, thresholds, side="right")
 
             fig, axis = plt.subplots(2, sharex=False, sharey=False, figsize=(8, 8))
             axis[0].plot((range(1, len(total) * 10, 10)), (total), lw=4, color="b", label="All cells")
@@ -531,16 +538,13 @@ fig.savefig(os.path.join(results_dir, "figures", "stats.all_samples.grna_assigne
 dists = dict()
 for sample in [w for w in prj.samples if s.genome == "human"]:
 
-    # read refFlat
-    ref = pd.read_csv(os.path.join("spiked_genomes", "hg38_spiked_HEKlibrary", "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.refFlat"), sep="\t", header=None)
-    ref = ref[range(6)]
-    ref.columns = ["gene_id", "transcript_id", "chrom", "strand", "start", "end"]
-    ref2 = ref.groupby(["gene_id", "chrom"])["end"].max()
+    # index of gene ends (written with the refFlat by guides_to_ref.py)
+    gene_ends = read_gene_ends(os.path.join("spiked_genomes", "hg38_spiked_HEKlibrary", "Homo_sapiens.GRCh38.dna.primary_assembly.spiked.gene_ends.npy"))
 
     # bam file
     bam = pysam.AlignmentFile(os.path.join("results_pipeline", sample.name, "star_gene_exon_tagged.clean.bam"))
     # iterate through reads, get read position
-    dist = list()
+    genes, chroms, ends = list(), list(), list()
     for i, aln in enumerate(bam):
         if i % 1e5 == 0:
             print(i)
@@ -552,12 +556,13 @@ for sample in [w for w in prj.samples if s.genome == "human"]:
             np.mean(aln.query_alignment_qualities) < 10  # low mapping Q (never happens, but for the future)
         ):
             continue
+        genes.append(aln.get_tag("GE"))
+        chroms.append(aln.reference_name)
+        ends.append(aln.reference_end)
 
-        # get distance from 3' end
-        try:
-            dist.append(ref2[aln.get_tag("GE"), aln.reference_name] - aln.reference_end)
-        except KeyError:
-            continue
+    # get distance from 3' end
+    dist = distance_to_gene_end(gene_ends, genes, chroms, ends)
+    dist = dist[~np.isnan(dist)].astype(int).tolist()
     dists[sample.name] = dist
     count = Counter(dist)
     c = pd.Series(count).rolling(window=10).median()
@@ -659,9 +664,7 @@ for i, sample in enumerate([sample for sample in prj.samples if hasattr(sample,
         print(sample.name, n_genes)
         # Gather additional metrics from transcriptome:
         try:
-            exp = pd.read_csv(
-                os.path.join(sample.paths.sample_root, "digital_expression.{}genes.tsv".format(n_genes)),
-                sep="\t").set_index("GENE")
+            exp = read_sample_expression(sample.paths.sample_root, n_genes=n_genes)
         except IOError:
             continue
         # reads per cell
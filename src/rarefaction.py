@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Bootstrap rarefaction of aggregate cell signatures against bulk samples.
+
+For each fraction of UMIs (see `signatures.downsampled_signatures`) and of cells,
+cells are drawn with replacement in many bootstrap replicates at once: the draws of
+all replicates form a sparse replicates x cells indicator matrix, whose product with
+the one-hot cells x groups matrix gives the number of cells and the summed signature
+of every group in every replicate. Correlations of the group means with the bulk are
+then computed for all replicates together.
+UMI fractions are processed in parallel and each one is checkpointed to disk.
+"""
+
+import os
+from multiprocessing import Pool
+import numpy as np
+import scipy.sparse
+
+from memoize import fingerprint
+
+
+def group_indicator(groups, n_groups):
+    """
+    One-hot cells x groups sparse matrix. Cells of group -1 belong to no group.
+    """
+    cells = np.where(groups >= 0)[0]
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(cells)), (cells, groups[cells])), shape=(len(groups), n_groups))
+
+
+def bootstrap_indicator(n_cells, n_sampled, n_replicates, random_state):
+    """
+    Replicates x cells sparse matrix of the number of times each cell is drawn
+    when sampling `n_sampled` cells with replacement in each replicate.
+    """
+    draws = random_state.randint(0, n_cells, size=(n_replicates, n_sampled))
+    replicates = np.repeat(np.arange(n_replicates), n_sampled)
+    # duplicate draws are summed
+    return scipy.sparse.csr_matrix(
+        (np.ones(draws.size), (replicates, draws.ravel())), shape=(n_replicates, n_cells))
+
+
+def masked_pearson(x, y, mask):
+    """
+    Pearson correlation between each row of `x` and `y`, on the columns where `mask` is True.
+    """
+    n = mask.sum(axis=1).astype(np.float64)
+    x = np.where(mask, x, 0)
+    y = np.where(mask, y, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mx = x.sum(axis=1) / n
+        my = y.sum(axis=1) / n
+        xc = np.where(mask, x - mx[:, np.newaxis], 0)
+        yc = np.where(mask, y - my[:, np.newaxis], 0)
+        return (xc * yc).sum(axis=1) / np.sqrt((xc ** 2).sum(axis=1) * (yc ** 2).sum(axis=1))
+
+
+# data shared with the worker processes of `rarefaction`
+_rarefaction = dict()
+
+
+def _init_rarefaction(data):
+    _rarefaction.update(data)
+
+
+def _rarefy_umi_fraction(j):
+    """
+    Correlations with the bulk of all cell fractions and replicates, at one fraction of UMIs.
+
+    :returns: cell fractions x replicates np.array.
+    """
+    d = _rarefaction
+    checkpoint = None
+    if d["checkpoint_dir"] is not None:
+        checkpoint = os.path.join(d["checkpoint_dir"], "umi_fraction.{}.{}.npy".format(j, d["key"]))
+        if os.path.exists(checkpoint):
+            return np.load(checkpoint)
+
+    random_state = np.random.RandomState(d["seed"] + j)
+    signatures = d["signatures"][j]
+    indicator = d["indicator"]
+    weighted = indicator.multiply(signatures[:, np.newaxis]).tocsr()
+    n_cells = len(signatures)
+
+    pearson = np.empty((len(d["cell_fractions"]), d["n_replicates"]))
+    for i, cell_fraction in enumerate(d["cell_fractions"]):
+        draws = bootstrap_indicator(n_cells, int(np.round(cell_fraction * n_cells)), d["n_replicates"], random_state)
+        counts = np.asarray((draws * indicator).todense())
+        sums = np.asarray((draws * weighted).todense())
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = sums / counts
+        means[means == 0] = 1  # to avoid -inf fold changes, as for the bulk
+        pearson[i] = masked_pearson(means, d["bulk"][np.newaxis, :], (counts > 0) & d["in_bulk"][np.newaxis, :])
+
+    if checkpoint is not None:
+        np.save(checkpoint, pearson)
+    return pearson
+
+
+def rarefaction(
+        signatures, groups, bulk, cell_fractions=np.linspace(0, 1, 100)[1:],
+        n_replicates=100, seed=0, processes=None, checkpoint_dir=None):
+    """
+    Pearson correlation between the mean signature of cell groups and that of bulk samples,
+    subsampling cells with replacement at each fraction of UMIs and of cells.
+
+    :param signatures: UMI fractions x cells np.array of the signature position of each cell.
+    :param groups: group code of each cell (-1 for cells in no group).
+    :param bulk: mean bulk signature of each group code (NaN for groups not in bulk).
+    :param checkpoint_dir: directory where the results of each UMI fraction are saved and
+                           loaded from if already there, to resume interrupted runs.
+                           Checkpoints are named by a fingerprint of all inputs, and those
+                           of other inputs are removed.
+    :returns: UMI fractions x cell fractions x replicates np.array.
+    """
+    bulk = np.asarray(bulk, dtype=np.float64)
+    signatures = np.asarray(signatures, dtype=np.float64)
+    groups = np.asarray(groups)
+    key = fingerprint(signatures, groups, bulk, np.asarray(cell_fractions), n_replicates, seed)
+    if checkpoint_dir is not None:
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        # checkpoints of previous runs on other inputs
+        for name in os.listdir(checkpoint_dir):
+            if name.startswith("umi_fraction.") and name.endswith(".npy") and key not in name:
+                os.remove(os.path.join(checkpoint_dir, name))
+    data = {
+        "signatures": signatures,
+        "indicator": group_indicator(groups, len(bulk)),
+        "bulk": np.nan_to_num(bulk), "in_bulk": ~np.isnan(bulk),
+        "cell_fractions": cell_fractions, "n_replicates": n_replicates,
+        "seed": seed, "checkpoint_dir": checkpoint_dir, "key": key}
+
+    pool = Pool(processes, initializer=_init_rarefaction, initargs=(data,))
+    results = pool.map(_rarefy_umi_fraction, range(data["signatures"].shape[0]))
+    pool.close()
+    pool.join()
+    return np.stack(results)
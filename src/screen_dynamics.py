@@ -433,9 +433,9 @@ mid_screen_counts.to_csv(os.path.join(results_dir, "gRNA_counts.mid_screen.csv")
 # get guide quantification from CROP-seq
 # merge output (reads in constructs and assignemnts) of each sample
 
-reads = pd.read_csv(os.path.join("results", "{}.guide_cell_gRNA_assignment.all.csv".format(experiment)))
-scores = pd.read_csv(os.path.join("results", "{}.guide_cell_scores.all.csv".format(experiment)))
-assignment = pd.read_csv(os.path.join("results", "{}.guide_cell_assignment.all.csv".format(experiment)))
+reads = pd.read_hdf(os.path.join("results", "{}.guide_cell_gRNA_assignment.all.hdf5".format(experiment)), "reads")
+scores = pd.read_hdf(os.path.join("results", "{}.guide_cell_scores.all.hdf5".format(experiment)), "scores")
+assignment = pd.read_hdf(os.path.join("results", "{}.guide_cell_assignment.all.hdf5".format(experiment)), "assignment")
 
 screen_counts = pd.pivot_table(assignment.groupby(["experiment", "condition", "assignment"]).apply(len).reset_index(), index="assignment", columns="condition", fill_value=0)
 screen_counts.columns = screen_counts.columns.droplevel(level=0)
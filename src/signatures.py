@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+Scoring of cells along a signature between two groups (e.g. stimulated and unstimulated),
+and of its robustness to the number of UMIs per cell.
+"""
+
+from multiprocessing import Pool
+import numpy as np
+import scipy.sparse
+from scipy.stats import t
+
+from memoize import memoize
+
+
+def signature_weights(n=101, bounds=(0, 0)):
+    """
+    Weights of the two groups in each of the `n` positions of a signature:
+    position p is p% of the first group and (100 - p)% of the second.
+    """
+    p = np.linspace(0 + bounds[0], n + bounds[1], n)
+    return p / n, (n - p) / n
+
+
+def generate_signature_matrix(array, n=101, bounds=(0, 0)):
+    """
+    :param np.array: 2D np.array
+    """
+    a, b = signature_weights(n, bounds)
+    return np.outer(array[:, 0], a) + np.outer(array[:, 1], b)
+
+
+def signature_correlations(matrix, x1, x2, n=101, bounds=(0, 0)):
+    """
+    Pearson correlation (and its p-value) of each column of `matrix` with each position of the
+    signature between `x1` and `x2` (see `generate_signature_matrix`).
+
+    As each position of the signature is a linear combination of `x1` and `x2`, all correlations
+    are computed from the products of the centered columns with `x1` and `x2` in one matrix multiplication.
+
+    :param matrix: genes x samples np.array.
+    :returns: tuple of samples x positions np.arrays of correlations and p-values.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    x = np.vstack([x1, x2]).T.astype(np.float64)
+    n_genes = matrix.shape[0]
+
+    yc = matrix - matrix.mean(axis=0)
+    xc = x - x.mean(axis=0)
+    cov_yx = yc.T.dot(xc)  # samples x 2
+    var_y = (yc ** 2).sum(axis=0)  # samples
+    cov_x = xc.T.dot(xc)  # 2 x 2
+
+    a, b = signature_weights(n, bounds)
+    cov_ys = np.outer(cov_yx[:, 0], a) + np.outer(cov_yx[:, 1], b)
+    var_s = a ** 2 * cov_x[0, 0] + b ** 2 * cov_x[1, 1] + 2 * a * b * cov_x[0, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cors = cov_ys / np.sqrt(np.outer(var_y, var_s))
+        cors = np.clip(cors, -1, 1)
+        # two-sided p-value of the correlation, as in scipy.stats.pearsonr
+        t_stat = cors * np.sqrt((n_genes - 2) / (1 - cors ** 2))
+    p_values = 2 * t.sf(np.abs(t_stat), n_genes - 2)
+    return cors, p_values
+
+
+def binomial_thin(counts, fraction, random_state):
+    """
+    Keep each UMI of a count matrix with probability `fraction`.
+    Only the non-zero values of sparse matrices are thinned.
+    """
+    if scipy.sparse.issparse(counts):
+        thinned = counts.copy()
+        thinned.data = random_state.binomial(thinned.data.astype(np.int64), fraction)
+        thinned.eliminate_zeros()
+        return thinned
+    return random_state.binomial(np.asarray(counts, dtype=np.int64), fraction)
+
+
+# data shared with the worker processes of `downsampled_signatures`
+_downsampling = dict()
+
+
+def _init_downsampling(data):
+    _downsampling.update(data)
+
+
+def _downsampled_signature(args):
+    """
+    Signature correlations of all cells with their UMIs thinned to `fraction`.
+    """
+    i, fraction = args
+    d = _downsampling
+    random_state = np.random.RandomState(d["seed"] + i)
+
+    counts = binomial_thin(d["counts"], fraction, random_state)
+    if scipy.sparse.issparse(counts):
+        counts = counts.toarray()
+    # the thinned total of the other genes of each cell is binomial too
+    totals = counts.sum(axis=0) + random_state.binomial(d["other_totals"], fraction)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norm = np.log2(1 + np.nan_to_num(counts / totals.astype(np.float64)) * 1e4)
+    return signature_correlations(norm, d["x1"], d["x2"], n=d["n"], bounds=d["bounds"])
+
+
+@memoize
+def downsampled_signatures(
+        counts, other_totals, x1, x2, fractions=np.linspace(0, 1, 100)[1:],
+        n=101, bounds=(0, 0), seed=0, processes=None):
+    """
+    Signature correlations of all cells with their UMIs binomially downsampled to several fractions.
+
+    UMIs are thinned on raw counts, which are then normalized by the thinned total counts of
+    each cell (log2 TPM, as in `normalization.normalize_matrix`) and scored with `signature_correlations`.
+    Fractions are processed in parallel, each with its own seed derived from `seed`.
+
+    :param counts: signature genes x cells matrix of UMI counts (np.ndarray or scipy.sparse).
+    :param other_totals: UMIs of each cell in the genes not in `counts`.
+    :returns: tuple of fractions x cells x positions np.arrays of correlations and p-values.
+    """
+    data = {
+        "counts": counts, "other_totals": np.asarray(other_totals, dtype=np.int64),
+        "x1": np.asarray(x1), "x2": np.asarray(x2), "n": n, "bounds": bounds, "seed": seed}
+    pool = Pool(processes, initializer=_init_downsampling, initargs=(data,))
+    results = pool.map(_downsampled_signature, list(enumerate(fractions)))
+    pool.close()
+    pool.join()
+
+    return np.stack([r[0] for r in results]), np.stack([r[1] for r in results])
+
+
+# data shared with the worker processes of `permutation_background`
+_permutations = dict()
+
+
+def _init_permutations(data):
+    _permutations.update(data)
+
+
+def _permutation_block(args):
+    """
+    Score a block of permutations of the matrix in one call to `signature_correlations`,
+    returning only their histograms of correlations per signature position and of best positions.
+    """
+    block, n_permutations = args
+    d = _permutations
+    random_state = np.random.RandomState(d["seed"] + block)
+    matrix = d["matrix"]
+
+    # shuffle all values of the matrix (across genes and cells), as many times as permutations in the block
+    flat = matrix.ravel()
+    permuted = np.hstack([random_state.permutation(flat).reshape(matrix.shape) for _ in range(n_permutations)])
+    cors, _ = signature_correlations(permuted, d["x1"], d["x2"], n=d["n"], bounds=d["bounds"])
+
+    # cells without variance have no correlation
+    cors = cors[np.isfinite(cors).all(axis=1)]
+    bins = d["bins"]
+    bin_index = np.clip(((cors + 1) / 2. * bins).astype(np.int64), 0, bins - 1)
+    positions = np.arange(cors.shape[1])
+    histogram = np.bincount(
+        (positions * bins + bin_index).ravel(), minlength=cors.shape[1] * bins).reshape(cors.shape[1], bins)
+    best = np.bincount(cors.argmax(axis=1), minlength=cors.shape[1])
+    return histogram, best
+
+
+@memoize
+def permutation_background(
+        matrix, x1, x2, n_permutations=1000, block_size=10,
+        n=101, bounds=(0, 0), bins=2000, seed=0, processes=None):
+    """
+    Null distribution of the signature correlations of cells, from permutations of all values of `matrix`.
+
+    Permutations are generated in blocks of `block_size`, each seeded from `seed` and its block number,
+    scored together in one matrix operation and spread over a process pool.
+    Only histograms of the permuted correlations at each signature position are kept, so that
+    memory does not grow with the number of permutations (see `background_quantiles`).
+
+    :param matrix: genes x cells np.array.
+    :returns: dict with "edges" of the correlation bins, "histogram" (positions x bins) of the correlations
+              and "best" (positions) of the number of permuted cells with their highest correlation at each position.
+    """
+    data = {
+        "matrix": np.asarray(matrix, dtype=np.float64), "x1": np.asarray(x1), "x2": np.asarray(x2),
+        "n": n, "bounds": bounds, "bins": bins, "seed": seed}
+    blocks = [
+        (block, min(block_size, n_permutations - start))
+        for block, start in enumerate(range(0, n_permutations, block_size))]
+
+    histogram = np.zeros((n, bins), dtype=np.int64)
+    best = np.zeros(n, dtype=np.int64)
+    pool = Pool(processes, initializer=_init_permutations, initargs=(data,))
+    for block_histogram, block_best in pool.imap_unordered(_permutation_block, blocks):
+        histogram += block_histogram
+        best += block_best
+    pool.close()
+    pool.join()
+
+    return {"edges": np.linspace(-1, 1, bins + 1), "histogram": histogram, "best": best}
+
+
+def background_quantiles(background, q=(0.01, 0.05, 0.5, 0.95, 0.99)):
+    """
+    Quantiles of the permuted correlations at each signature position (up to the width of a bin).
+
+    :returns: positions x quantiles np.array.
+    """
+    cumulative = np.cumsum(background["histogram"], axis=1)
+    quantiles = np.empty((cumulative.shape[0], len(q)))
+    for i, counts in enumerate(cumulative):
+        quantiles[i] = background["edges"][1:][np.searchsorted(counts, np.asarray(q) * counts[-1])]
+    return quantiles
+
+
+def save_background(output_file, background):
+    np.savez_compressed(output_file, **background)
+
+
+def load_background(input_file):
+    data = np.load(input_file)
+    return {k: data[k] for k in data.files}
+
+
+def save_downsampling(output_file, fractions, cors, p_values):
+    np.savez_compressed(output_file, fractions=np.asarray(fractions), cors=cors, p_values=p_values)
+
+
+def load_downsampling(input_file):
+    """
+    :returns: tuple of fractions, and fractions x cells x positions correlations and p-values.
+    """
+    data = np.load(input_file)
+    return data["fractions"], data["cors"], data["p_values"]